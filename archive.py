@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import threading
+import sqlite3
+import json
+import time
+import os
+import re
+
+# Segmenty archiwum: nowy plik po przekroczeniu tego rozmiaru, starszych się nie zmienia
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Co ile sekund dopisywać zebrane rundy
+FLUSH_INTERVAL = 1.0
+
+# Słowa zapytania; reszta znaków jest pomijana, więc składnia FTS nie przechodzi od klienta
+WORD = re.compile(r"\w+")
+
+
+# Archiwum rund: każdy aforyzm to jedna linia json w segmentach dopisywanych na końcu,
+# a obok w SQLite indeks odwrócony (FTS5) po tekście i haśle oraz indeks po autorze.
+# Segmenty są źródłem prawdy - indeks można odbudować z nich po awarii.
+class Archive:
+    def __init__(self, path="archive"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "index.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, segment INTEGER NOT NULL, "
+                        "offset INTEGER NOT NULL, author TEXT NOT NULL, votes INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS docs_author ON docs (author, votes)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS docs_votes ON docs (votes)")
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5("
+                        "text, title, content='', tokenize='unicode61 remove_diacritics 2')")
+        # Do którego miejsca segmentów sięga indeks
+        self.db.execute("CREATE TABLE IF NOT EXISTS progress (segment INTEGER NOT NULL, offset INTEGER NOT NULL)")
+        if self.db.execute("SELECT COUNT(*) FROM progress").fetchone()[0] == 0:
+            self.db.execute("INSERT INTO progress VALUES (1, 0)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        # Zapis do plików i indeksu osobno, żeby add z pokoju nie czekał na fsync
+        self.write_lock = threading.Lock()
+        # Rekordy czekające na zapis
+        self.pending = []
+        self.closed = False
+        # Każdy wątek czyta przez własne połączenie - w WAL nie blokuje zapisu
+        self.readers = threading.local()
+        self.segment = self.catch_up()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, "segment-{:06d}.log".format(segment))
+
+    # Dopisanie do indeksu rekordów z segmentów, których indeks jeszcze nie zna
+    # (nowa paczka albo przerwany zapis); zwraca numer ostatniego segmentu
+    def catch_up(self):
+        segment, offset = self.db.execute("SELECT segment, offset FROM progress").fetchone()
+        while os.path.exists(self.segment_path(segment)):
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                segment_file.seek(offset)
+                data = segment_file.read()
+            # Urwana ostatnia linia nie trafiła nigdzie - ucinamy ją
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                os.truncate(self.segment_path(segment), offset + end)
+            lines = []
+            position = offset
+            for line in data[:end].splitlines(keepends=True):
+                lines.append((segment, position, json.loads(line)))
+                position += len(line)
+            self.index(lines, segment, position)
+            if not os.path.exists(self.segment_path(segment + 1)):
+                break
+            segment, offset = segment + 1, 0
+        return segment
+
+    # Runda po podliczeniu głosów: entries = [(autor, tekst, głosy), ...]
+    def add(self, room, title, entries):
+        now = time.time()
+        with self.lock:
+            for author, text, votes in entries:
+                self.pending.append({"room": room, "title": title, "author": author,
+                                     "text": text, "votes": votes, "time": now})
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            path = self.segment_path(self.segment)
+            if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_SIZE:
+                self.segment += 1
+                path = self.segment_path(self.segment)
+            with open(path, 'ab') as segment_file:
+                segment_file.write(b"".join(json.dumps(record, ensure_ascii=False).encode('utf8') + b"\n"
+                                            for record in pending))
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            # Indeks doczytuje wszystko od swojego końca, więc nieudana paczka trafi tam przy następnej
+            self.catch_up()
+
+    # Jedna transakcja na paczkę: dokumenty, słowa i nowe miejsce końca indeksu
+    def index(self, lines, segment, offset):
+        try:
+            for line_segment, line_offset, record in lines:
+                cursor = self.db.execute("INSERT INTO docs (segment, offset, author, votes) VALUES (?, ?, ?, ?)",
+                                         (line_segment, line_offset, record["author"], record["votes"]))
+                self.db.execute("INSERT INTO terms (rowid, text, title) VALUES (?, ?, ?)",
+                                (cursor.lastrowid, record["text"], record["title"]))
+            self.db.execute("UPDATE progress SET segment = ?, offset = ?", (segment, offset))
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+
+    def reader(self):
+        db = getattr(self.readers, "db", None)
+        if db is None:
+            db = self.readers.db = sqlite3.connect(os.path.join(self.path, "index.db"))
+        return db
+
+    # Najlepsze (albo najnowsze) aforyzmy ze słowami z query i/lub danego autora.
+    # Zwraca (wpisy, czy jest następna strona)
+    def search(self, query=None, author=None, offset=0, limit=20, order="votes"):
+        words = WORD.findall(query or "")
+        conditions = []
+        params = []
+        source = "docs"
+        if words:
+            source = "terms JOIN docs ON docs.id = terms.rowid"
+            conditions.append("terms MATCH ?")
+            params.append(" ".join('"{}"'.format(word) for word in words))
+        if author:
+            conditions.append("docs.author = ?")
+            params.append(author)
+        sql = "SELECT docs.segment, docs.offset FROM " + source
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY docs.votes DESC, docs.id DESC" if order == "votes" else " ORDER BY docs.id DESC"
+        sql += " LIMIT ? OFFSET ?"
+        # Jeden wiersz więcej mówi, czy jest kolejna strona - bez liczenia wszystkich trafień
+        rows = self.reader().execute(sql, params + [limit + 1, offset]).fetchall()
+        return [self.read(segment, position) for segment, position in rows[:limit]], len(rows) > limit
+
+    # Teksty ostatnich count aforyzmów, od najstarszego - segmenty czytane od końca
+    def recent(self, count):
+        chunks = []
+        segment = self.segment
+        while count > 0 and os.path.exists(self.segment_path(segment)):
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                lines = segment_file.read().splitlines()[-count:]
+            chunks.append(lines)
+            count -= len(lines)
+            segment -= 1
+        for lines in reversed(chunks):
+            for line in lines:
+                try:
+                    yield json.loads(line)["text"]
+                except ValueError:
+                    # Linia właśnie dopisywana przez wątek zapisu
+                    continue
+
+    def read(self, segment, offset):
+        with open(self.segment_path(segment), 'rb') as segment_file:
+            segment_file.seek(offset)
+            return json.loads(segment_file.readline())
+
+    def run(self):
+        while not self.closed:
+            with self.lock:
+                self.flushed.wait(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except (OSError, sqlite3.Error) as error:
+                print("Unable to archive rounds: {!r}".format(error))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.flushed.notify()
+        self.writer.join()
+        self.flush()
+        with self.write_lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
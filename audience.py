@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import time
+
+import metrics
+
+# Co ile sekund zebrane delty idą do widzów jedną paczką
+BATCH_INTERVAL = 0.1
+
+
+# Kilka zakodowanych wiadomości sklejonych w jeden bufor. Interfejs jak Payload,
+# więc bufor dla danego kodowania powstaje raz i trafia do wszystkich widzów
+class Batch:
+    def __init__(self, payloads):
+        self.payloads = payloads
+        self.frames = {}
+
+    def frame(self, encoding="json"):
+        frame = self.frames.get(encoding)
+        if frame is None:
+            frame = self.frames[encoding] = b"".join(payload.frame(encoding) for payload in self.payloads)
+        return frame
+
+
+# Widzowie pokoju: tylko odbierają stan, nie są graczami i nie liczą się do barier faz.
+# Delty z publish są zbierane i co BATCH_INTERVAL idą do każdego widza jednym zapisem.
+# Wywołujący trzyma lock pokoju
+class Audience:
+    def __init__(self, room):
+        self.room = room
+        # id -> połączenie widza
+        self.connections = {}
+        # Delty czekające na najbliższą paczkę
+        self.pending = []
+        self.scheduled = False
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection):
+        # Nowy widz dostaje snapshot z opublikowanym stanem, więc starsze delty
+        # muszą wyjść wcześniej - inaczej dostałby wersje, które już ma
+        self.send_pending()
+        self.connections[connection.id] = connection
+        connection.watching = self.room
+        self.resync(connection)
+
+    def remove(self, connection):
+        if self.connections.get(connection.id) is connection:
+            del self.connections[connection.id]
+        connection.watching = None
+
+    def resync(self, connection):
+        # Snapshot jest nowszy niż czekające delty - te muszą wyjść przed nim,
+        # inaczej widz po snapshocie dostałby wersje, które już ma
+        self.send_pending()
+        connection.send(self.room.snapshot_payload(connection), "snapshot")
+
+    def push(self, payload):
+        if not self.connections:
+            return
+        self.pending.append(payload)
+        if not self.scheduled:
+            self.scheduled = True
+            self.room.server.scheduler.call_later(BATCH_INTERVAL, self.flush)
+
+    def flush(self):
+        with self.room.lock:
+            self.scheduled = False
+            self.send_pending()
+
+    def send_pending(self):
+        pending, self.pending = self.pending, []
+        if not pending or not self.connections:
+            return
+        start = time.perf_counter()
+        batch = Batch(pending)
+        for connection in list(self.connections.values()):
+            connection.send(batch, "delta")
+        metrics.broadcast.observe(time.perf_counter() - start)
+        metrics.recipients.inc(len(self.connections))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import asyncio
+import argparse
+import random
+import json
+import time
+import os
+
+import protocol
+import state
+
+# Scenariusze: (liczba graczy, graczy w pokoju); None = wszyscy w jednym pokoju
+SCENARIOS = {
+    "small-rooms": (300, 3),
+    "medium-rooms": (500, 25),
+    "huge-room": (500, None),
+}
+
+
+# Statystyki jednego pokoju - boty w tym samym procesie dzielą zegar,
+# więc opóźnienie przejścia liczymy od wysłania ostatniej wiadomości przed barierą
+class RoomStats:
+    def __init__(self, name):
+        self.name = name
+        # stan -> czas wysłania ostatniej akcji, która do niego prowadzi
+        self.sent = {}
+        self.bots = []
+        self.done = 0
+
+    # Boty zostają w pokoju, aż wszystkie rozegrają swoje rundy - inaczej ostatnim
+    # zabrakłoby graczy do rundy i czekałyby do timeoutu
+    def finish(self):
+        self.done += 1
+        if self.done == len(self.bots):
+            for bot in self.bots:
+                bot.writer.close()
+
+
+class Stats:
+    def __init__(self):
+        self.joins = []
+        self.transitions = {"vote": [], "display": []}
+        self.rounds = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = 0
+        # Bajty odebrane przez widzów, osobno od graczy
+        self.spectator_bytes = 0
+
+
+# Bezgłowy gracz: dołącza, pisze aforyzm i głosuje na losowy cudzy
+class Bot:
+    def __init__(self, host, port, name, room, stats, rounds, rng, encoding):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.room = room
+        self.stats = stats
+        self.rounds = rounds
+        self.rng = rng
+        self.data = {}
+        self.version = -1
+        self.player_id = None
+        self.played = 0
+        # Runda liczy się tylko, jeśli bot w niej pisał - dołączenie w trakcie display to nie gra
+        self.submitted = False
+        self.offered = encoding
+        self.encoding = "json"
+
+    def send(self, message):
+        frame = protocol.frame(json.dumps(message, ensure_ascii=False))
+        self.stats.bytes_sent += len(frame)
+        self.writer.write(frame)
+
+    async def run(self):
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.send({"type": "join", "name": self.name, "room": self.room.name,
+                   "encodings": [self.offered]})
+        decoder = protocol.Decoder()
+        try:
+            while True:
+                chunk = await self.reader.read(protocol.READ_SIZE)
+                if not chunk:
+                    break
+                self.stats.bytes_received += len(chunk)
+                for message in decoder.feed(chunk):
+                    message = protocol.loads(message, self.encoding)
+                    previous = self.data.get("state")
+                    if message["type"] == "welcome":
+                        self.encoding = message["encoding"]
+                        continue
+                    if message["type"] == "ping":
+                        self.send({"type": "pong"})
+                        continue
+                    # Duży pokój: głos na losową kartkę z własnej strony
+                    if message["type"] == "ballot":
+                        if message["entries"] and self.data.get("state") == "vote":
+                            self.send({"type": "vote", "player": self.rng.choice(message["entries"])[0]})
+                        continue
+                    if message["type"] == "snapshot":
+                        if self.player_id is None:
+                            self.stats.joins.append(time.perf_counter() - start)
+                        self.data = message["data"]
+                        self.version = message["version"]
+                        self.player_id = str(message.get("playerid", self.player_id))
+                    elif message["type"] == "delta":
+                        if message["version"] != self.version + 1:
+                            if self.version >= 0:
+                                self.version = -1
+                                self.send({"type": "resync"})
+                            continue
+                        state.apply(self.data, message["changes"], message["removed"])
+                        self.version = message["version"]
+                    else:
+                        continue
+                    if self.data.get("state") != previous:
+                        self.on_state(self.data["state"])
+        except ConnectionError:
+            self.stats.errors += 1
+        finally:
+            self.writer.close()
+
+    def on_state(self, current):
+        now = time.perf_counter()
+        if current in self.stats.transitions and current in self.room.sent:
+            self.stats.transitions[current].append(now - self.room.sent[current])
+        if current == "game":
+            self.send({"type": "submit", "text": "{} o {} #{}".format(
+                self.name, self.data.get("title", ""), self.rng.randrange(10 ** 6))})
+            self.submitted = True
+            self.room.sent["vote"] = now
+        elif current == "vote":
+            self.room.sent["display"] = now
+            if self.data.get("large"):
+                return
+            choices = [key for key in self.data["messages"] if key != self.player_id]
+            if choices:
+                self.send({"type": "vote", "player": self.rng.choice(choices)})
+        elif current == "display":
+            if self.submitted and self.played < self.rounds:
+                self.played += 1
+                self.stats.rounds += 1
+                if self.played == self.rounds:
+                    self.room.finish()
+            self.submitted = False
+
+
+# Widz: ogląda pokój, dopóki gracze grają, liczy odebrane bajty i odpowiada na pingi
+async def spectate(host, port, room, stats, encoding):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(protocol.frame(json.dumps({"type": "watch", "room": room.name, "encodings": [encoding]})))
+    decoder = protocol.Decoder()
+    current = "json"
+    try:
+        while True:
+            chunk = await reader.read(protocol.READ_SIZE)
+            if not chunk:
+                break
+            stats.spectator_bytes += len(chunk)
+            for message in decoder.feed(chunk):
+                message = protocol.loads(message, current)
+                if message["type"] == "welcome":
+                    current = message["encoding"]
+                elif message["type"] == "ping":
+                    writer.write(protocol.frame(json.dumps({"type": "pong"})))
+    finally:
+        writer.close()
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000
+    return {"p50": round(pick(0.5), 2), "p90": round(pick(0.9), 2),
+            "p99": round(pick(0.99), 2), "max": round(values[-1] * 1000, 2)}
+
+
+async def bench(host, port, players, room_size, rounds, ramp, seed, timeout, encoding, spectators=0):
+    stats = Stats()
+    rng = random.Random(seed)
+    # Nazwy pokojów unikalne dla przebiegu, żeby nie trafić na stare gry
+    prefix = "bench-{}-{}".format(os.getpid(), seed)
+    size = room_size or players
+    rooms = [RoomStats("{}-{}".format(prefix, i)) for i in range((players + size - 1) // size)]
+    bots = [Bot(host, port, "bot{}".format(i), rooms[i // size], stats, rounds,
+                random.Random(rng.random()), encoding) for i in range(players)]
+    for bot in bots:
+        bot.room.bots.append(bot)
+    start = time.perf_counter()
+    tasks = []
+    for bot in bots:
+        # Bot, który utknął (np. niepełny pokój), liczy się jako błąd
+        tasks.append(asyncio.ensure_future(asyncio.wait_for(bot.run(), timeout)))
+        if ramp:
+            await asyncio.sleep(ramp / players)
+    # Widzowie wchodzą do pokojów założonych już przez boty
+    watchers = [asyncio.ensure_future(spectate(host, port, room, stats, encoding))
+                for room in rooms for _ in range(spectators)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    for watcher in watchers:
+        watcher.cancel()
+    await asyncio.gather(*watchers, return_exceptions=True)
+    stats.errors += sum(1 for result in results if isinstance(result, Exception))
+    return {
+        "players": players,
+        "rooms": len(rooms),
+        "elapsed": round(elapsed, 3),
+        "join_ms": percentiles(stats.joins),
+        "to_vote_ms": percentiles(stats.transitions["vote"]),
+        "to_display_ms": percentiles(stats.transitions["display"]),
+        # Rundy liczone per pokój, nie per bot
+        "rounds_per_sec": round(stats.rounds / size / elapsed, 2) if elapsed else 0,
+        "bytes_sent": stats.bytes_sent,
+        "bytes_received": stats.bytes_received,
+        "spectator_bytes": stats.spectator_bytes,
+        "errors": stats.errors,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aphorism load generator')
+    parser.add_argument('host', help='Server address')
+    parser.add_argument('--port', type=int, default=7312)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='small-rooms')
+    parser.add_argument('--players', type=int, help='Override the number of bots')
+    parser.add_argument('--room-size', type=int, help='Override bots per room')
+    parser.add_argument('--rounds', type=int, default=3, help='Rounds each bot plays')
+    parser.add_argument('--ramp', type=float, default=1.0, help='Seconds over which bots connect')
+    parser.add_argument('--timeout', type=float, default=120, help='Give up on a bot after this many seconds')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for repeatable runs')
+    parser.add_argument('--encoding', choices=protocol.ENCODINGS, default='json',
+                        help='Wire encoding the bots ask for')
+    parser.add_argument('--spectators', type=int, default=0, help='Watch-only connections per room')
+    parser.add_argument('--json', action='store_true', help='Print one JSON line for comparisons')
+    args = parser.parse_args()
+
+    players, room_size = SCENARIOS[args.scenario]
+    players = args.players or players
+    room_size = args.room_size or room_size
+    report = asyncio.run(bench(args.host, args.port, players, room_size, args.rounds, args.ramp,
+                               args.seed, args.timeout, args.encoding, args.spectators))
+    report["scenario"] = args.scenario
+    report["encoding"] = args.encoding
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print("{:16} {}".format(key, value))
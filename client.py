@@ -6,60 +6,218 @@ import tkinter.messagebox
 from tkinter.constants import NSEW
 import threading
 import socket
+import queue
 import json
-from functools import partial
+import time
+
+import protocol
+import state
+
+# Ile miejsc rankingu pokazywać na ekranie wyników
+LEADERBOARD_SIZE = 5
+
+# Co ile ms wątek Tk odbiera zdarzenia z wątku sieciowego
+POLL_INTERVAL = 50
+
+# Jak długo próbować wrócić do sesji po zerwaniu połączenia (serwer czeka 30 s)
+RECONNECT_TIME = 25
+
+# Ile pingów serwera może nie przyjść, zanim połączenie uznamy za zerwane
+MISSED_PINGS = 3
+
+PORT = 7312
+
+# Ile sekund czekać na odpowiedź na zapytanie lobby
+QUERY_TIMEOUT = 5
+
+# Ile pokojów i wyników wyszukiwania pokazywać na ekranie powitalnym
+ROOMS_SHOWN = 10
+RESULTS_SHOWN = 10
+
+
+# Jednorazowe zapytanie lobby na osobnym połączeniu - bez dołączania do pokoju
+def ask(host, port, message):
+    with socket.create_connection((host, port), timeout=QUERY_TIMEOUT) as sock:
+        sock.sendall(protocol.frame(json.dumps(message, ensure_ascii=False)))
+        decoder = protocol.Decoder()
+        while True:
+            chunk = sock.recv(protocol.READ_SIZE)
+            if not chunk:
+                raise ConnectionError("connection closed")
+            for reply in decoder.feed(chunk):
+                reply = json.loads(reply)
+                # Pingi mogą przyjść przed odpowiedzią
+                if reply["type"] != "ping":
+                    return reply
 
 class Client(threading.Thread):
-    def __init__(self, host, port, username, gui):
+    def __init__(self, host, port, username, gui, room="main", watch=False):
         super().__init__()
         self.host = host
         self.port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.name = username
+        self.room = room
+        # Widz tylko ogląda pokój - serwer nie liczy go jako gracza
+        self.watch = watch
         self.gui = gui
+        # Lokalna kopia stanu serwera i jej wersja
+        self.data = {}
+        self.version = -1
+        # Chroni data przed odczytem z wątku Tk w trakcie nakładania delty
+        self.lock = threading.Lock()
+        # Kodowanie wiadomości od serwera - json do czasu potwierdzenia
+        self.encoding = "json"
+        # Token sesji z powitania serwera
+        self.session = None
+        self.closed = False
         self.start()
 
     def start(self):
+        self.connect()
+        super().start()
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.host, self.port))
         print('Connected to {}:{}'.format(self.host, self.port))
-
-        # Wyślij username na powitanie
-        self.sock.sendall(self.name.encode('utf8'))
-        super().start()
+        self.encoding = "json"
+        # Wyślij username i pokój na powitanie - nieistniejący pokój zostanie utworzony,
+        # a z tokenem serwer oddaje poprzednią sesję
+        join = {"type": "join", "name": self.name, "room": self.room, "encodings": protocol.ENCODINGS}
+        if self.watch:
+            join["type"] = "watch"
+        elif self.session is not None:
+            join["session"] = self.session
+        self.request(join)
+
+    # Po zerwaniu połączenia wracamy z tym samym tokenem, póki serwer trzyma miejsce
+    def reconnect(self):
+        deadline = time.monotonic() + RECONNECT_TIME
+        delay = 0.1
+        while not self.closed and (self.session is not None or self.watch) and time.monotonic() < deadline:
+            time.sleep(delay)
+            try:
+                self.connect()
+                return not self.closed
+            except OSError:
+                delay = min(delay * 2, 2)
+        return False
 
     def close(self):
+        self.closed = True
+        try:
+            # Samo close nie zrywa połączenia, gdy wątek wisi w recv
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
         try:
             self.sock.close()
         except:
             pass
 
+    def request(self, message):
+        try:
+            self.sock.sendall(protocol.frame(json.dumps(message, ensure_ascii=False)))
+        except OSError:
+            # Zerwane połączenie - wątek odbierający spróbuje wrócić do sesji
+            pass
+
     def send(self, message):
-        self.sock.sendall(message.encode('utf8'))
+        self.request({"type": "submit", "text": message})
 
     def vote(self, player):
-        self.sock.sendall(str(player).encode('utf8'))
+        self.request({"type": "vote", "player": player})
+
+    # Ranking globalny
+    def top(self, count=10, offset=0):
+        self.request({"type": "top", "count": count, "offset": offset})
+
+    # Kolejna strona kartek w dużym pokoju
+    def ballot(self, offset):
+        self.request({"type": "ballot", "offset": offset})
+
+    def rank(self, name=None):
+        self.request({"type": "rank", "name": name or self.name})
+
+    # Snapshot zastępuje stan, delta jest nakładana tylko na poprzednią wersję
+    def update(self, message):
+        if message["type"] == "snapshot":
+            self.data = message["data"]
+            self.version = message["version"]
+            # Informacja zwrotna ma playerid => ustaw playerid
+            if "playerid" in message:
+                self.gui.post("player", int(message["playerid"]))
+            return True
+        if message["type"] == "delta":
+            if message["version"] != self.version + 1:
+                # Zgubiona wersja - prosimy o pełny stan, do tego czasu ignorujemy delty
+                if self.version >= 0:
+                    self.version = -1
+                    self.request({"type": "resync"})
+                return False
+            state.apply(self.data, message["changes"], message["removed"])
+            self.version = message["version"]
+            return True
+        return False
 
     def run(self):
-        # Słuchanie wiadomości od serwera
+        while self.listen() and self.reconnect():
+            pass
+        self.close()
+
+    # Słuchanie wiadomości od serwera; True, gdy połączenie zostało zerwane
+    def listen(self):
+        decoder = protocol.Decoder()
         try:
             while True:
-                message = self.sock.recv(4096).decode('utf8')
-                if message:
-                    data = json.loads(message)
-                    # Informacja zwrotna ma playerid => ustaw playerid
-                    if "playerid" in data:
-                        self.gui.player_id = int(data["playerid"])
-                    self.gui.server_data = data
-                    if data["state"] == "vote":
-                        self.gui.messages = []
-                        for key in data["messages"]:
-                            self.gui.messages.append((key, data["messages"][key]))
-                    self.gui.switch_to(data["state"])
-
-                else:
-                    self.close()
+                chunk = self.sock.recv(protocol.READ_SIZE)
+                if not chunk:
+                    return True
+                for message in decoder.feed(chunk):
+                    message = protocol.loads(message, self.encoding)
+                    if message["type"] == "welcome":
+                        self.encoding = message["encoding"]
+                        self.session = message.get("session")
+                        # Serwer pinguje co heartbeat sekund - dłuższa cisza to martwe połączenie
+                        if message.get("heartbeat"):
+                            self.sock.settimeout(message["heartbeat"] * MISSED_PINGS)
+                        continue
+                    if message["type"] == "ping":
+                        self.request({"type": "pong"})
+                        continue
+                    # GUI dostaje tylko zdarzenia - widgetów dotyka wyłącznie wątek Tk
+                    if message["type"] == "top":
+                        self.gui.post("top", message["entries"])
+                        continue
+                    if message["type"] == "ballot":
+                        self.gui.post("ballot", message)
+                        continue
+                    if message["type"] == "duplicate":
+                        self.gui.post("duplicate", message)
+                        continue
+                    if message["type"] == "rank":
+                        self.gui.post("rank", (message["rank"], message["score"]))
+                        continue
+                    if message["type"] == "error":
+                        self.gui.post("error", message["reason"])
+                        continue
+                    if message["type"] == "score":
+                        self.gui.post("score", (message["score"], message["total"]))
+                        continue
+                    with self.lock:
+                        previous = self.data.get("state")
+                        if not self.update(message):
+                            continue
+                        current = self.data["state"]
+                    # Po podliczeniu głosów odświeżamy ranking
+                    if current == "display" and previous != "display":
+                        self.rank()
+                        self.top(LEADERBOARD_SIZE)
+                    self.gui.post("state")
+        except OSError:
+            return True
         except:
-            self.close()
+            return False
 
 class GUI(tk.Frame):
     def __init__(self, master=None):
@@ -83,17 +241,31 @@ class GUI(tk.Frame):
         self.BG_COLOR = '#36393f'
         self.FONT_COLOR = '#cccccc'
 
-        # Dane wysłane przez serwer
+        # Dane wysłane przez serwer - kopia robiona w wątku Tk
         self.server_data = {}
+        # Zdarzenia z wątku sieciowego, odbierane w drain
+        self.events = queue.Queue()
+        # Faza, w której gracz już wysłał tekst albo głos - do jej końca ekran czekania
+        self.waiting = None
 
-        # Ramki tkintera
+        # Ramki tkintera, tworzone raz i potem tylko aktualizowane
         self.frames = {}
+        self.screen = None
 
         self.frames["welcome"] = self.draw_welcome_screen()
         self.switch_to("welcome")
 
         self.messages = []
         self.player_id = -1
+        # Ranking globalny: [miejsce, nazwa, wynik] i (miejsce, wynik) gracza
+        self.leaderboard = []
+        self.rank = None
+        # Strona kartek do głosowania w dużym pokoju i (punkty, suma) gracza z jego rundy
+        self.ballot = None
+        self.score = None
+        # Uwaga pod polem aforyzmu (np. o powtórzonym tekście) i hasło, dla którego jest pole
+        self.notice = ""
+        self.round_title = None
 
         # Ustawianie domyślnych wartości
         if "username" in domyslne:
@@ -102,8 +274,10 @@ class GUI(tk.Frame):
             self.address_entry.insert(0, domyslne["hostname"])
         else:
             self.address_entry.insert(0, "localhost")
+        self.room_entry.insert(0, domyslne.get("room", "main"))
 
         self.master.title("AFORYZMY")
+        self.after(POLL_INTERVAL, self.drain)
     
     def add_file_menu(self):
         self.menubar = tk.Menu(self.master)
@@ -145,6 +319,7 @@ class GUI(tk.Frame):
         self.config["DEFAULT"]["bazowa_geometria"] = geometria
         self.config["DEFAULT"]["username"] = self.username_entry.get()
         self.config["DEFAULT"]["hostname"] = self.address_entry.get()
+        self.config["DEFAULT"]["room"] = self.room_entry.get()
         try:
             with open("client_config.ini", 'w') as config_file:
                 self.config.write(config_file)
@@ -157,6 +332,7 @@ class GUI(tk.Frame):
         if self.client is not None:
             self.client.close()
             self.client = None
+            self.waiting = None
             self.switch_to("welcome")
 
     def quit(self, event=None):
@@ -172,76 +348,158 @@ class GUI(tk.Frame):
 
     def connect(self):
         if len(self.username_entry.get()) > 0:
-            self.client = Client(self.address_entry.get(), 7312, self.username_entry.get(), self)
+            self.client = Client(self.address_entry.get(), PORT, self.username_entry.get(), self,
+                                 self.room_entry.get() or "main", self.watch_var.get())
+
+    # Zapytanie lobby w osobnym wątku; odpowiedź wraca jako zdarzenie kind, błąd jako "error"
+    def query(self, kind, message):
+        host = self.address_entry.get()
+
+        def run():
+            try:
+                reply = ask(host, PORT, message)
+            except (OSError, ValueError):
+                self.post("error", "Brak połączenia z {}".format(host))
+                return
+            if reply["type"] == "error":
+                self.post("error", reply["reason"])
+            else:
+                self.post(kind, reply)
+        threading.Thread(target=run, daemon=True).start()
+
+    def list_rooms(self):
+        self.query("rooms", {"type": "list", "offset": 0, "limit": ROOMS_SHOWN})
+
+    # Archiwum rund: najlepsze aforyzmy ze słowami z pola wyszukiwania
+    def search(self):
+        self.query("results", {"type": "search", "query": self.search_entry.get(), "limit": RESULTS_SHOWN})
 
     def upload(self):
-        if len(self.aphorism_entry.get()) > 0:
+        if len(self.aphorism_entry.get()) > 0 and not self.client.watch:
+            self.waiting = "game"
             self.switch_to("wait")
             self.client.send(self.aphorism_entry.get())
 
     def vote(self, player):
+        if self.client.watch:
+            return
+        self.waiting = "vote"
         self.switch_to("wait")
         self.client.vote(player)
 
-    # Zmiana ramki
+    def next_ballot(self):
+        if self.client is not None and self.ballot is not None:
+            self.client.ballot(self.ballot["next"])
+
+    # Wywoływane z wątku sieciowego
+    def post(self, kind, value=None):
+        self.events.put((kind, value))
+
+    # Odbiór zdarzeń w wątku Tk; seria zmian stanu daje jedno odświeżenie ekranu
+    def drain(self):
+        changed = False
+        try:
+            while True:
+                kind, value = self.events.get_nowait()
+                if kind == "player":
+                    self.player_id = value
+                elif kind == "top":
+                    self.leaderboard = value
+                elif kind == "rank":
+                    self.rank = value
+                elif kind == "results":
+                    rows = [(None, "{} - {} ({}, {})".format(entry["text"], entry["author"], entry["title"],
+                                                              entry["votes"]))
+                            for entry in value["entries"]]
+                    if not rows:
+                        rows = [(None, "Nic nie znaleziono")]
+                    self.fill(self.result_rows, self.search_list, rows, self.search_label)
+                elif kind == "ballot":
+                    self.ballot = value
+                elif kind == "score":
+                    self.score = value
+                elif kind == "rooms":
+                    rows = [(room["name"], "{} ({} graczy, {})".format(room["name"], room["players"], room["state"]))
+                            for room in value["rooms"]]
+                    self.fill(self.room_buttons, self.room_list, rows, self.room_button)
+                elif kind == "error":
+                    tkinter.messagebox.showwarning("Aforyzmy", value, master=self.master)
+                    # Serwer nie wpuścił do pokoju - z powrotem do ekranu powitalnego
+                    if self.client is not None and not self.client.data:
+                        self.disconnect()
+                elif kind == "duplicate":
+                    self.notice = "Podobny aforyzm już był: {}".format(value["similar"])
+                    # Odrzucony tekst - z powrotem do pisania
+                    if value["rejected"]:
+                        self.waiting = None
+                changed = True
+        except queue.Empty:
+            pass
+        if changed and self.client is not None:
+            with self.client.lock:
+                self.server_data = state.plain(self.client.data)
+            self.refresh()
+        self.after(POLL_INTERVAL, self.drain)
+
+    def refresh(self):
+        current = self.server_data.get("state")
+        if current is None:
+            return
+        if self.waiting != current:
+            self.waiting = None
+        self.messages = list(self.server_data["messages"].items())
+        self.switch_to("wait" if self.waiting == current else current)
+
+    # Zmiana ramki; ramka jest budowana tylko przy pierwszym użyciu, potem aktualizowana
     def switch_to(self, state):
-        for frame in self.frames:
-            self.frames[frame].grid_forget()
-        # Welcome jest jedyną "statyczną" ramką i nie powinna być reinicjalizowana, bo ma przypisane wartości domyślne
+        # Welcome jest jedyną "statyczną" ramką i nie jest aktualizowana, bo ma przypisane wartości domyślne
         if state != "welcome":
-            self.frames[state] = self.draw_screen(state)
-        self.frames[state].grid(row=1, column=0, columnspan=1, rowspan=1, sticky=NSEW)
-
-    # Utworzenie danej ramki
+            if state not in self.frames:
+                self.frames[state] = self.draw_screen(state)
+            self.update_screen(state)
+        if state != self.screen:
+            if self.screen is not None:
+                self.frames[self.screen].grid_forget()
+            self.frames[state].grid(row=1, column=0, columnspan=1, rowspan=1, sticky=NSEW)
+            self.screen = state
+
+    # Utworzenie danej ramki - tylko stałe widgety, treść wstawia update_screen
     def draw_screen(self, type):
+        frame = tk.Frame(self.master, background=self.BG_COLOR)
         if type == "wait":
-            frame = tk.Frame(self.master, background=self.BG_COLOR)
             label = tk.Label(frame, text="Oczekiwanie na innych graczy", pady=100, bg=self.BG_COLOR, fg=self.FONT_COLOR)
             label.pack()
             return frame
+        title_label = tk.Label(frame, text="AFORYZMY", bg=self.BG_COLOR, fg=self.FONT_COLOR, font="Helvetica 22")
+        title_label.pack()
         if type == "vote":
-            frame = tk.Frame(self.master, background=self.BG_COLOR)
-            title_label = tk.Label(frame, text="AFORYZMY", bg=self.BG_COLOR, fg=self.FONT_COLOR, font="Helvetica 22")
-            title_label.pack()
-
-            tk.Label(frame, text="Wybierz ulubiony aforyzm na temat {}".format(self.server_data["title"].upper()), fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12", height="2", anchor="n").pack()
-
-            for message in self.messages:
-                player, text = message
-                if str(player) != str(self.player_id):
-                    tk.Button(frame, text=text, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12", width="80", height="3", pady="2", relief="flat", command=partial(self.vote, player)).pack()
-
+            self.vote_label = tk.Label(frame, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12", height="2", anchor="n")
+            self.vote_label.pack()
+            # Przyciski w osobnej ramce, żeby dokładane na koniec listy nie mieszały się z resztą
+            self.vote_list = tk.Frame(frame, background=self.BG_COLOR)
+            self.vote_list.pack()
+            self.vote_buttons = []
+            # Duży pokój: czołówka na żywo i następna strona kartek
+            self.leaders_label = tk.Label(frame, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 10")
+            self.leaders_label.pack()
+            self.more_button = tk.Button(frame, text="Inne aforyzmy", command=self.next_ballot)
             return frame
         if type == "display":
-            frame = tk.Frame(self.master, background=self.BG_COLOR)
-            title_label = tk.Label(frame, text="AFORYZMY", bg=self.BG_COLOR, fg=self.FONT_COLOR, font="Helvetica 22")
-            title_label.pack()
-
             tk.Label(frame, text="Wyniki", fg=self.FONT_COLOR, bg=self.BG_COLOR,
                      font="Helvetica 12", height="2", anchor="n").pack()
+            self.result_list = tk.Frame(frame, background=self.BG_COLOR)
+            self.result_list.pack(fill="x")
+            self.result_labels = []
 
-            for message in self.messages:
-                player, text = message
-                total_score = 0
-                score = 0
-                if player in self.server_data["total_scores"]:
-                    total_score = self.server_data["total_scores"][player]
-                if player in self.server_data["scores"]:
-                    score = self.server_data["scores"][player]
-                tk.Label(frame, text="{} ({}): {} ({})".format(self.server_data["users"][player], total_score, text, score), fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12", width="100", anchor="nw",
-                          height="3", pady="2", padx="2").pack(fill="x")
-
+            self.ranking_label = tk.Label(frame, fg=self.FONT_COLOR, bg=self.BG_COLOR,
+                                          font="Helvetica 12", height="2", anchor="n")
+            self.ranking_label.pack(side="bottom")
             tk.Label(frame, text="Kolejna runda rozpocznie się za chwilę", fg=self.FONT_COLOR, bg=self.BG_COLOR,
                      font="Helvetica 12", height="3", anchor="n").pack(side="bottom")
-
             return frame
         if type == "game":
-            frame = tk.Frame(self.master, background=self.BG_COLOR)
-            title_label = tk.Label(frame, text="AFORYZMY", bg=self.BG_COLOR, fg=self.FONT_COLOR, font="Helvetica 22")
-            title_label.pack()
-
-            tk.Label(frame, text="Napisz złotą myśl na temat wyrazu {}".format(self.server_data["title"].upper()),
-                     fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12").pack()
+            self.game_label = tk.Label(frame, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12")
+            self.game_label.pack()
             sv = tk.StringVar()
             self.aphorism_entry = tk.Entry(frame, width=80, textvariable=sv)
             sv.trace_add("write", lambda x, y, z: self.key_fix(sv, 100))
@@ -249,8 +507,82 @@ class GUI(tk.Frame):
 
             send_button = tk.Button(frame, text="Wyślij", command=self.upload)
             send_button.pack()
+            self.notice_label = tk.Label(frame, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 10")
+            self.notice_label.pack()
             return frame
-    
+
+    # Wstawienie aktualnych danych do istniejącej ramki - zmieniane są tylko teksty, które się różnią
+    def update_screen(self, type):
+        data = self.server_data
+        if type == "game":
+            self.set_text(self.game_label, "Napisz złotą myśl na temat wyrazu {}".format(data["title"].upper()))
+            # Nowe hasło czyści pole; zmiany w trakcie rundy (i odrzucony tekst) nie przerywają pisania
+            if data["title"] != self.round_title:
+                self.round_title = data["title"]
+                self.notice = ""
+                self.aphorism_entry.delete(0, tk.END)
+            self.set_text(self.notice_label, self.notice)
+        elif type == "vote":
+            self.set_text(self.vote_label, "Wybierz ulubiony aforyzm na temat {}".format(data["title"].upper()))
+            messages = self.messages
+            if data.get("large"):
+                messages = [(str(player), text) for player, text in self.ballot["entries"]] if self.ballot else []
+            rows = [(player, text + (" (podobny do wcześniejszego)" if player in data.get("duplicates", {}) else ""))
+                    for player, text in messages if str(player) != str(self.player_id)]
+            self.fill(self.vote_buttons, self.vote_list, rows, self.vote_button)
+            leaders = ", ".join("{} ({})".format(name, votes) for _, name, votes in data.get("leaders", []))
+            self.set_text(self.leaders_label, "Prowadzą: " + leaders if leaders else "")
+            if data.get("large") and not self.more_button.winfo_manager():
+                self.more_button.pack()
+            elif not data.get("large") and self.more_button.winfo_manager():
+                self.more_button.pack_forget()
+        elif type == "display":
+            rows = []
+            for player, text in self.messages:
+                total_score = data["total_scores"].get(player, 0)
+                score = data["scores"].get(player, 0)
+                rows.append((player, "{} ({}): {} ({})".format(data["users"].get(player, "?"), total_score, text, score)))
+            self.fill(self.result_labels, self.result_list, rows, self.result_label, fill="x")
+            ranking = ""
+            # Duży pokój pokazuje wszystkim tylko czołówkę - własny wynik przychodzi osobno
+            if data.get("large") and self.score is not None:
+                score, total_score = self.score
+                ranking = "Twój wynik: {} ({}) | ".format(total_score, score)
+            if self.leaderboard:
+                ranking += "Ranking: " + ", ".join("{}. {} ({})".format(*entry) for entry in self.leaderboard)
+                if self.rank is not None and self.rank[0] is not None:
+                    ranking += " | Twoje miejsce: {}".format(self.rank[0])
+            self.set_text(self.ranking_label, ranking)
+
+    # Pula widgetów listy: istniejące dostają nowy tekst, brakujące są dokładane, nadmiarowe chowane
+    def fill(self, pool, parent, rows, create, **pack):
+        for index, (player, text) in enumerate(rows):
+            if index == len(pool):
+                pool.append(create(parent))
+            widget = pool[index]
+            widget.player = player
+            self.set_text(widget, text)
+            if not widget.winfo_manager():
+                widget.pack(**pack)
+        for widget in pool[len(rows):]:
+            if widget.winfo_manager():
+                widget.pack_forget()
+
+    def vote_button(self, parent):
+        button = tk.Button(parent, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12", width="80", height="3", pady="2", relief="flat")
+        # Komenda ustawiona raz; gracz, na którego głosuje przycisk, zmienia się z listą
+        button.configure(command=lambda: self.vote(button.player))
+        return button
+
+    def result_label(self, parent):
+        return tk.Label(parent, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12", width="100", anchor="nw",
+                        height="3", pady="2", padx="2")
+
+    # configure tylko przy zmianie - każda zmiana tekstu to ponowne przeliczenie układu
+    def set_text(self, widget, text):
+        if widget.cget("text") != text:
+            widget.configure(text=text)
+
     def draw_welcome_screen(self):
         frame = tk.Frame(self.master, background=self.BG_COLOR)
         title_label = tk.Label(frame, text="AFORYZMY", bg=self.BG_COLOR, fg=self.FONT_COLOR, font="Helvetica 22")
@@ -266,10 +598,46 @@ class GUI(tk.Frame):
         self.address_entry = tk.Entry(frame)
         self.address_entry.pack()
 
+        tk.Label(frame, text="Pokój", fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12").pack()
+        self.room_entry = tk.Entry(frame)
+        self.room_entry.pack()
+
+        self.watch_var = tk.BooleanVar()
+        tk.Checkbutton(frame, text="Tylko oglądaj", variable=self.watch_var, fg=self.FONT_COLOR, bg=self.BG_COLOR,
+                       selectcolor=self.BG_COLOR, activebackground=self.BG_COLOR).pack()
+
         title_button = tk.Button(frame, text="Połącz", command=self.connect, anchor="s")
         title_button.pack()
+
+        # Lobby: pokoje serwera; kliknięty pokój trafia do pola Pokój
+        tk.Button(frame, text="Pokoje", command=self.list_rooms).pack(pady=(20, 0))
+        self.room_list = tk.Frame(frame, background=self.BG_COLOR)
+        self.room_list.pack()
+        self.room_buttons = []
+
+        # Archiwum: wyszukiwanie aforyzmów z poprzednich rund
+        tk.Label(frame, text="Archiwum", fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 12").pack(pady=(20, 0))
+        self.search_entry = tk.Entry(frame, width=40)
+        self.search_entry.bind("<Return>", lambda event: self.search())
+        self.search_entry.pack()
+        tk.Button(frame, text="Szukaj", command=self.search).pack()
+        self.search_list = tk.Frame(frame, background=self.BG_COLOR)
+        self.search_list.pack(fill="x")
+        self.result_rows = []
         return frame
 
+    def search_label(self, parent):
+        return tk.Label(parent, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 10", anchor="w")
+
+    def room_button(self, parent):
+        button = tk.Button(parent, fg=self.FONT_COLOR, bg=self.BG_COLOR, font="Helvetica 10", width="40", relief="flat")
+        button.configure(command=lambda: self.choose_room(button.player))
+        return button
+
+    def choose_room(self, name):
+        self.room_entry.delete(0, tk.END)
+        self.room_entry.insert(0, name)
+
 
     # Poprawienie polskich znaków i usuwanie =; limit znaków
     def key_fix(self, sv, limit):
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import collections
+import unicodedata
+import itertools
+import threading
+import hashlib
+import struct
+import time
+import zlib
+import os
+import re
+
+import metrics
+
+# Co robić z tekstem podobnym do już wysłanego
+OFF = "off"
+FLAG = "flag"
+REJECT = "reject"
+POLICIES = (OFF, FLAG, REJECT)
+
+# Długość shingla w znakach - aforyzmy są krótkie, więc znaki, nie słowa
+SHINGLE = 4
+# MinHash: 16 wartości w 4 pasmach po 4; pasmo zgodne w całości daje kandydata
+PERMUTATIONS = 16
+BANDS = 4
+ROWS = PERMUTATIONS // BANDS
+# Odsetek zgodnych wartości podpisu, od którego tekst uznajemy za prawie taki sam
+THRESHOLD = 0.75
+# Ile ostatnich tekstów pamiętać i ilu kandydatów najwyżej sprawdzać
+HISTORY = 100000
+MAX_CANDIDATES = 64
+
+WORD = re.compile(r"\w+")
+
+# MinHash z jedną permutacją: każdy shingiel jest haszowany raz (crc32 w C, potem mnożenie
+# przez nieparzystą stałą), górne bity wybierają jedną z PERMUTATIONS przegródek, a podpis to
+# minimum w każdej przegródce. Puste przegródki biorą wartość następnej niepustej.
+# Podpis jest trzymany jako bajty - kilka razy mniej pamięci niż krotka intów
+MIX = 0x9E3779B1
+SLOT_SHIFT = 32 - (PERMUTATIONS - 1).bit_length()
+EMPTY = 1 << 32
+VALUE = struct.Struct("<I")
+SIGNATURE = struct.Struct("<{}I".format(PERMUTATIONS))
+BAND_SIZE = ROWS * VALUE.size
+# Plik podpisów zapisywany przy wyjściu: nagłówek z liczbą wpisów, dalej wpisy
+# (skrót, podpis, długość tekstu) i sam tekst w utf8
+CACHE_HEADER = struct.Struct("<4sI")
+CACHE_MAGIC = b"APD2"
+CACHE_ENTRY = struct.Struct("<Q{}sI".format(SIGNATURE.size))
+# Historia wczytywana porcjami; po każdej przerwa tak długa jak jej liczenie,
+# żeby przy starcie nie zabierać GIL obsłudze klientów
+SEED_SLICE = 1000
+
+checked = metrics.REGISTRY.histogram(
+    "aphorism_duplicate_lookup_seconds", "Time spent looking one submission up in the similarity index")
+found = metrics.REGISTRY.counter(
+    "aphorism_duplicate_submissions_total", "Submissions similar to an earlier one, by action", ["action"])
+
+
+# Małe litery, bez znaków diakrytycznych i interpunkcji
+def normalize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(WORD.findall(text))
+
+
+def digest(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+def signature(normalized):
+    # utf-32: każdy znak to 4 bajty, więc shingle to zwykłe wycinki bajtów
+    data = normalized.encode('utf-32-le')
+    width = SHINGLE * 4
+    shingles = {data[i:i + width] for i in range(0, max(len(data) - width, 0) + 1, 4)}
+    slots = [EMPTY] * PERMUTATIONS
+    for value in map(zlib.crc32, shingles):
+        value = value * MIX & 0xFFFFFFFF
+        slot = value >> SLOT_SHIFT
+        if value < slots[slot]:
+            slots[slot] = value
+    for slot in range(PERMUTATIONS):
+        step = 1
+        while slots[slot] == EMPTY:
+            slots[slot] = slots[(slot + step) % PERMUTATIONS]
+            step += 1
+    return SIGNATURE.pack(*slots)
+
+
+def bands(sign):
+    return [sign[band * BAND_SIZE:(band + 1) * BAND_SIZE] for band in range(BANDS)]
+
+
+def similarity(sign, other):
+    return sum(sign[i:i + VALUE.size] == other[i:i + VALUE.size]
+               for i in range(0, SIGNATURE.size, VALUE.size)) / PERMUTATIONS
+
+
+# Indeks podobieństwa: identyczne po normalizacji przez skrót, prawie identyczne
+# przez LSH na podpisach MinHash. Pamięta HISTORY ostatnich tekstów
+class Index:
+    def __init__(self, history=HISTORY, threshold=THRESHOLD):
+        self.history = history
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        # id -> (skrót, podpis, tekst)
+        self.docs = {}
+        # skrót znormalizowanego tekstu -> id
+        self.exact = {}
+        # dla każdego pasma: wartości pasma -> ids
+        self.bands = [{} for _ in range(BANDS)]
+        # Kolejność dodania, do usuwania najstarszych
+        self.order = collections.deque()
+
+    def __len__(self):
+        return len(self.docs)
+
+    # Najbardziej podobny zapamiętany tekst: (podobieństwo, tekst) albo None;
+    # ignore to id, którego nie porównujemy (poprzedni tekst tego samego gracza)
+    def find(self, text, ignore=None):
+        start = time.perf_counter()
+        normalized = normalize(text)
+        if not normalized:
+            return None
+        key = digest(normalized)
+        sign = signature(normalized)
+        best = None
+        with self.lock:
+            doc = self.exact.get(key)
+            if doc is not None and doc != ignore:
+                best = (1.0, self.docs[doc][2])
+            else:
+                candidates = set()
+                for band_key, buckets in zip(bands(sign), self.bands):
+                    candidates.update(buckets.get(band_key, ()))
+                    if len(candidates) >= MAX_CANDIDATES:
+                        break
+                candidates.discard(ignore)
+                for doc in itertools.islice(candidates, MAX_CANDIDATES):
+                    _, other, other_text = self.docs[doc]
+                    value = similarity(sign, other)
+                    if value >= self.threshold and (best is None or value > best[0]):
+                        best = (value, other_text)
+        checked.observe(time.perf_counter() - start)
+        return best
+
+    # Zwraca id tekstu w indeksie albo None, gdy nie ma czego indeksować;
+    # cached to gotowe (skrót, podpis) z pliku podpisów
+    def add(self, text, cached=None):
+        if cached is not None:
+            key, sign = cached
+        else:
+            normalized = normalize(text)
+            if not normalized:
+                return None
+            key = digest(normalized)
+            sign = signature(normalized)
+        with self.lock:
+            doc = next(self.ids)
+            self.docs[doc] = (key, sign, text)
+            self.exact[key] = doc
+            for band_key, buckets in zip(bands(sign), self.bands):
+                buckets.setdefault(band_key, []).append(doc)
+            self.order.append(doc)
+            while len(self.docs) > self.history:
+                self.drop(self.order.popleft())
+        return doc
+
+    def remove(self, doc):
+        with self.lock:
+            self.drop(doc)
+
+    def drop(self, doc):
+        entry = self.docs.pop(doc, None)
+        if entry is None:
+            return
+        key, sign, _ = entry
+        if self.exact.get(key) == doc:
+            del self.exact[key]
+        for band_key, buckets in zip(bands(sign), self.bands):
+            bucket = buckets.get(band_key)
+            if bucket is not None:
+                bucket.remove(doc)
+                if not bucket:
+                    del buckets[band_key]
+
+    # Wczytanie historii (od najstarszych), np. z archiwum w tle przy starcie. Podpisy
+    # tekstów z pliku path nie są liczone od nowa - to one kosztują najwięcej
+    def seed(self, texts, path=None):
+        cache = load(path) if path else {}
+        count = cached = 0
+        start = time.perf_counter()
+        for text in texts:
+            entry = cache.get(text)
+            self.add(text, entry)
+            count += 1
+            cached += entry is not None
+            if count % SEED_SLICE == 0:
+                time.sleep(time.perf_counter() - start)
+                start = time.perf_counter()
+        print('Similarity index seeded with {} aphorisms ({} from {})'.format(count, cached, path))
+
+    # Zapis podpisów przez plik tymczasowy, kolejność od najstarszych
+    def save(self, path):
+        with self.lock:
+            entries = [self.docs[doc] for doc in self.order if doc in self.docs]
+        temp = path + ".tmp"
+        with open(temp, 'wb') as cache_file:
+            cache_file.write(CACHE_HEADER.pack(CACHE_MAGIC, len(entries)))
+            for key, sign, text in entries:
+                encoded = text.encode('utf8')
+                cache_file.write(CACHE_ENTRY.pack(key, sign, len(encoded)))
+                cache_file.write(encoded)
+        os.replace(temp, path)
+
+
+# Podpisy z pliku: tekst -> (skrót, podpis); brak albo uszkodzony plik to pusty słownik
+def load(path):
+    try:
+        with open(path, 'rb') as cache_file:
+            data = cache_file.read()
+    except OSError:
+        return {}
+    cache = {}
+    try:
+        magic, count = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC:
+            return {}
+        position = CACHE_HEADER.size
+        for _ in range(count):
+            key, sign, size = CACHE_ENTRY.unpack_from(data, position)
+            position += CACHE_ENTRY.size
+            cache[data[position:position + size].decode('utf8')] = (key, sign)
+            position += size
+    except (struct.error, UnicodeDecodeError):
+        return {}
+    return cache
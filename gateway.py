@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import subprocess
+import threading
+import asyncio
+import argparse
+import hashlib
+import bisect
+import json
+import sys
+import os
+
+import protocol
+import ratelimit
+import store
+
+# Punkty każdego serwera na pierścieniu - im więcej, tym równiej rozłożone pokoje
+REPLICAS = 100
+
+# Pierwszy port serwerów uruchamianych przez gateway
+WORKER_PORT = 7400
+
+# Ile sekund klient bez pokoju może nic nie wysyłać; w pokoju pilnuje tego serwer
+IDLE_TIMEOUT = 30
+
+# Pokój klientów, którzy go nie podali - jak DEFAULT_ROOM w server.py
+DEFAULT_ROOM = "main"
+
+
+def digest(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf8'), digest_size=8).digest(), 'big')
+
+
+# Spójne haszowanie: pokój należy do pierwszego serwera za jego skrótem na pierścieniu.
+# Po dodaniu albo utracie serwera przenoszą się tylko pokoje z jego odcinków
+class HashRing:
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = list(nodes)
+        points = sorted((digest("{}#{}".format(node, i)), node) for node in self.nodes for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    # Kolejne różne serwery dla klucza: pierwszy to właściciel, dalej zapasowe
+    def lookup(self, key):
+        start = bisect.bisect(self.hashes, digest(key))
+        seen = set()
+        for i in range(len(self.owners)):
+            node = self.owners[(start + i) % len(self.owners)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+
+def address(node):
+    host, _, port = node.rpartition(":")
+    return host, int(port)
+
+
+# Front dla kilku procesów serwera. Klient łączy się jak z jednym serwerem; join albo watch
+# wybiera serwer z pierścienia, a dalej ramki idą w obie strony bez dekodowania treści
+# odpowiedzi. Wiadomości klienta (zawsze json) są czytane, bo join do pokoju z innego serwera
+# przełącza połączenie, a create, list i search obsługuje sam gateway
+class Gateway:
+    def __init__(self, nodes, ip_rate=ratelimit.IP_RATE, ip_burst=ratelimit.IP_BURST, idle_timeout=IDLE_TIMEOUT):
+        self.ring = HashRing(nodes)
+        self.idle_timeout = idle_timeout
+        # Serwery widzą wszystkich klientów pod adresem gatewaya, więc limit na adres jest tutaj
+        self.addresses = ratelimit.AddressLimits(ip_rate, ip_burst)
+
+    async def accept(self, reader, writer):
+        decoder = protocol.Decoder(protocol.MAX_MESSAGE)
+        peer = writer.get_extra_info('peername')
+        client_address = peer[0] if peer else ""
+        limit = self.addresses.acquire(client_address)
+        upstream = None
+        try:
+            while True:
+                # Klienta w pokoju pinguje jego serwer; w lobby cisze mierzy sam gateway
+                timeout = self.idle_timeout if upstream is None and self.idle_timeout > 0 else None
+                chunk = await asyncio.wait_for(reader.read(protocol.READ_SIZE), timeout)
+                if not chunk:
+                    break
+                for message in decoder.feed(chunk):
+                    if not limit.take():
+                        continue
+                    # Zła wiadomość jest pomijana, jak na serwerze - połączenie zostaje
+                    try:
+                        request = json.loads(message)
+                    # RecursionError: głęboko zagnieżdżone listy mieszczą się w limicie ramki
+                    except (ValueError, RecursionError):
+                        continue
+                    if not isinstance(request, dict):
+                        continue
+                    kind = request.get("type")
+                    # Przełączenie tylko, dopóki serwer nie potwierdził wejścia do gry - serwer i tak
+                    # pomija join i watch gracza w pokoju, a zamknięcie połączenia z jego serwerem
+                    # odłączyłoby go od gry. Odrzucony join nie blokuje następnego do innego pokoju
+                    if kind in ("join", "watch") and not (upstream is not None and upstream.joined):
+                        room = str(request.get("room", DEFAULT_ROOM))
+                        if upstream is None or next(self.ring.lookup(room)) != upstream.node:
+                            if upstream is not None:
+                                upstream.close()
+                            upstream = await self.connect(room, writer)
+                    # Polecenia lobby odpowiada gateway, a połączenie z serwerem gracza zostaje
+                    elif kind == "create":
+                        room = str(request.get("room", ""))
+                        self.reply(writer, await self.ask(room, request))
+                        continue
+                    elif kind == "list":
+                        self.reply(writer, await self.list_rooms(request))
+                        continue
+                    elif kind == "search":
+                        self.reply(writer, await self.search(request))
+                        continue
+                    elif upstream is None:
+                        upstream = await self.connect(DEFAULT_ROOM, writer)
+                    elif kind == "leave":
+                        upstream.joined = False
+                    if upstream is None:
+                        self.reply(writer, {"type": "error", "reason": "no server available"})
+                        continue
+                    upstream.writer.write(protocol.frame(message))
+                if upstream is not None:
+                    await upstream.writer.drain()
+        except (ConnectionError, ValueError, asyncio.TimeoutError):
+            pass
+        finally:
+            if upstream is not None:
+                upstream.close()
+            self.addresses.release(client_address)
+            writer.close()
+
+    # Połączenie z właścicielem pokoju; gdy nie odpowiada, z kolejnym serwerem na pierścieniu
+    async def connect(self, room, writer):
+        for node in self.ring.lookup(room):
+            try:
+                reader, upstream_writer = await asyncio.open_connection(*address(node))
+            except OSError:
+                print('Server {} is unavailable'.format(node))
+                continue
+            return Upstream(node, reader, upstream_writer, writer)
+        return None
+
+    def reply(self, writer, response):
+        writer.write(protocol.frame(json.dumps(response, ensure_ascii=False)))
+
+    # Jednorazowe pytanie do właściciela pokoju albo kolejnego serwera na pierścieniu
+    async def ask(self, room, request):
+        for node in self.ring.lookup(room):
+            try:
+                return await self.query(node, request)
+            except (OSError, ValueError):
+                print('Server {} is unavailable'.format(node))
+        return {"type": "error", "reason": "no server available"}
+
+    # Lista pokojów ze wszystkich serwerów
+    async def list_rooms(self, request):
+        forwarded = {"type": "list", "offset": 0, "limit": protocol.MAX_LIST}
+        replies = await asyncio.gather(*(self.query(node, forwarded) for node in self.ring.nodes),
+                                       return_exceptions=True)
+        rooms = []
+        total = 0
+        for reply in replies:
+            if isinstance(reply, dict):
+                rooms.extend(reply["rooms"])
+                total += reply["total"]
+        offset, limit = protocol.page(request.get("offset", 0), request.get("limit", 100))
+        return {"type": "rooms", "rooms": rooms[offset:offset + limit], "offset": offset, "total": total}
+
+    # Wyszukiwanie w archiwach wszystkich serwerów: każdy oddaje swoje pierwsze offset + limit
+    # trafień, a gateway scala je w tym samym porządku co archiwum
+    async def search(self, request):
+        offset, limit = protocol.page(request.get("offset", 0), request.get("limit", 20))
+        query = str(request.get("query") or "")
+        author = str(request.get("author") or "")
+        order = "recent" if request.get("order") == "recent" else "votes"
+        forwarded = {"type": "search", "query": query, "author": author, "order": order,
+                     "offset": 0, "limit": min(offset + limit, protocol.MAX_LIST)}
+        replies = await asyncio.gather(*(self.query(node, forwarded) for node in self.ring.nodes),
+                                       return_exceptions=True)
+        results = [reply for reply in replies if isinstance(reply, dict) and reply["type"] == "results"]
+        if not results:
+            return {"type": "error", "reason": "no archive"}
+        entries = [entry for reply in results for entry in reply["entries"]]
+        if order == "votes":
+            entries.sort(key=lambda entry: (entry["votes"], entry["time"]), reverse=True)
+        else:
+            entries.sort(key=lambda entry: entry["time"], reverse=True)
+        more = len(entries) > offset + limit or any(reply["more"] for reply in results)
+        return {"type": "results", "query": query, "author": author, "order": order,
+                "offset": offset, "entries": entries[offset:offset + limit], "more": more}
+
+    async def query(self, node, request):
+        reader, writer = await asyncio.open_connection(*address(node))
+        try:
+            writer.write(protocol.frame(json.dumps(request)))
+            decoder = protocol.Decoder()
+            while True:
+                chunk = await reader.read(protocol.READ_SIZE)
+                if not chunk:
+                    raise ConnectionError("{} closed the connection".format(node))
+                for message in decoder.feed(chunk):
+                    reply = json.loads(message)
+                    # Pingi mogą przyjść przed odpowiedzią
+                    if reply["type"] != "ping":
+                        return reply
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        gateway_server = await asyncio.start_server(self.accept, host, port, reuse_address=True, backlog=1024)
+        print('Gateway at {} for {}'.format(gateway_server.sockets[0].getsockname(), ", ".join(self.ring.nodes)))
+        async with gateway_server:
+            await gateway_server.serve_forever()
+
+
+# Powitanie po join jest zawsze w json i jako jedyne ma token sesji (widz go nie dostaje);
+# pozostałe wiadomości mogą być już w innym kodowaniu, więc najpierw tani test początku
+def confirms_join(message):
+    if not message.startswith(b'{"type": "welcome"'):
+        return False
+    try:
+        return "session" in json.loads(message)
+    except ValueError:
+        return False
+
+
+# Połączenie gatewaya z jednym serwerem; odpowiedzi serwera są kopiowane do klienta
+# całymi ramkami, żeby po przełączeniu na inny serwer klient nie dostał kawałka starej
+class Upstream:
+    def __init__(self, node, reader, writer, client):
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.client = client
+        # Czy serwer przyjął join klienta - dopiero wtedy klient gra w pokoju na tym serwerze
+        self.joined = False
+        self.task = asyncio.ensure_future(self.pipe())
+
+    async def pipe(self):
+        decoder = protocol.Decoder()
+        try:
+            while True:
+                chunk = await self.reader.read(protocol.READ_SIZE)
+                if not chunk:
+                    break
+                messages = decoder.feed(chunk)
+                if not self.joined:
+                    self.joined = any(map(confirms_join, messages))
+                if messages:
+                    self.client.write(b"".join(protocol.frame(message) for message in messages))
+                    await self.client.drain()
+        except ConnectionError:
+            pass
+        # Serwer zniknął albo zamknął klienta - klient sam wróci przez gateway z tokenem sesji.
+        # Przy przełączeniu na inny serwer to połączenie jest już zamknięte przez gateway
+        if not self.writer.is_closing():
+            self.client.close()
+
+    # Zadanie kopiujące jest przerywane od razu - nic ze starego serwera nie trafi już do klienta
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+# Procesy pod gatewayem: magazyn wyników i serwery na kolejnych portach.
+# Serwer kończy się (z zapisem stanu) po zamknięciu wejścia - tak jak po Ctrl+D
+def spawn(args, extra):
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Własna sesja procesów, żeby Ctrl+C trafiał tylko do gatewaya, a ten zamykał je po kolei
+    processes = [subprocess.Popen([sys.executable, os.path.join(here, "store.py"), "127.0.0.1",
+                                   "--port", str(args.store_port), "--scores", args.scores],
+                                  stdin=subprocess.PIPE, start_new_session=True)]
+    nodes = []
+    for i in range(args.workers):
+        port = args.worker_port + i
+        command = [sys.executable, os.path.join(here, "server.py"), "127.0.0.1", "--engine", "async",
+                   "--port", str(port), "--scores", "remote:127.0.0.1:{}".format(args.store_port),
+                   "--archive", os.path.join(args.archive, "worker-{}".format(i)) if args.archive else "",
+                   "--snapshot", "state-{}.snap".format(i), "--ip-rate", "0",
+                   "--idle-timeout", str(args.idle_timeout)]
+        processes.append(subprocess.Popen(command + extra, stdin=subprocess.PIPE, start_new_session=True))
+        nodes.append("127.0.0.1:{}".format(port))
+    return processes, nodes
+
+
+def stop(processes):
+    # Najpierw serwery, bo przy wyjściu wysyłają jeszcze wyniki do magazynu
+    for process in processes[1:] + processes[:1]:
+        process.stdin.close()
+        process.wait()
+
+
+# Wyjście po zamknięciu wejścia, jak na serwerze; Ctrl+C przerywa asyncio.run
+def exit(processes):
+    try:
+        while True:
+            input('')
+    except (KeyboardInterrupt, EOFError):
+        pass
+    stop(processes)
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aphorism gateway: routes rooms to several server processes',
+                                     epilog='Other arguments are passed on to the spawned servers')
+    parser.add_argument('host', help='Interface the gateway listens at')
+    parser.add_argument('--port', type=int, default=7312)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Server processes to start on this host')
+    parser.add_argument('--worker-port', type=int, default=WORKER_PORT,
+                        help='Port of the first spawned server; the rest use the following ports')
+    parser.add_argument('--server', action='append', default=[], metavar='HOST:PORT',
+                        help='Route to an already running server instead of spawning them (repeatable)')
+    parser.add_argument('--store-port', type=int, default=store.STORE_PORT,
+                        help='Port of the spawned shared score store')
+    parser.add_argument('--scores', default='sqlite:scores.db',
+                        help='Backend of the spawned score store')
+    parser.add_argument('--ip-rate', type=float, default=ratelimit.IP_RATE,
+                        help='Messages per second all connections from one address may send (0 disables the limit)')
+    parser.add_argument('--ip-burst', type=int, default=ratelimit.IP_BURST,
+                        help='Messages all connections from one address may send at once above their rate')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='Seconds a client that is not in a room may stay silent (0 disables)')
+    parser.add_argument('--archive', default='archive',
+                        help="Directory for the servers' round archives, one subdirectory each (empty to disable)")
+    args, extra = parser.parse_known_args()
+
+    processes = []
+    if args.server:
+        nodes = args.server
+    else:
+        processes, nodes = spawn(args, extra)
+    threading.Thread(target=exit, args=(processes,), daemon=True).start()
+    try:
+        asyncio.run(Gateway(nodes, args.ip_rate, args.ip_burst, args.idle_timeout).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop(processes)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import threading
+import random
+
+# Wysokość skip listy - wystarcza na miliardy graczy
+MAX_LEVEL = 32
+
+
+class Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # width[i] = o ile pozycji przesuwa skok next[i] (None = koniec listy)
+        self.width = [1] * level
+
+
+# Indeksowana skip lista: wstawianie, usuwanie, pozycja klucza i dostęp
+# do i-tego elementu w O(log n)
+class SkipList:
+    def __init__(self):
+        self.head = Node(None, MAX_LEVEL)
+        self.size = 0
+        # Najwyższy używany poziom - wyżej nie ma co przeszukiwać
+        self.level = 1
+
+    def random_level(self):
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def insert(self, key):
+        chain = [self.head] * MAX_LEVEL
+        steps = [0] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(self.level)):
+            while node.next[level] is not None and node.next[level].key <= key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        new = Node(key, self.random_level())
+        # Nowe poziomy: z głowy od razu do końca listy
+        for level in range(self.level, len(new.next)):
+            self.head.width[level] = self.size + 1
+        self.level = max(self.level, len(new.next))
+        distance = 0
+        for level in range(len(new.next)):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - distance
+            prev.width[level] = distance + 1
+            distance += steps[level]
+        for level in range(len(new.next), self.level):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    # Budowa z posortowanych kluczy w O(n) - szybki start przy milionach graczy
+    def build(self, keys):
+        last = [self.head] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        for position, key in enumerate(keys, 1):
+            node = Node(key, self.random_level())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = position - positions[level]
+                last[level] = node
+                positions[level] = position
+            self.level = max(self.level, len(node.next))
+            self.size = position
+        for level in range(self.level):
+            last[level].width[level] = self.size + 1 - positions[level]
+
+    def remove(self, key):
+        chain = [self.head] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(self.level)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.level):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    # Liczba kluczy mniejszych od key
+    def index(self, key):
+        position = 0
+        node = self.head
+        for level in reversed(range(self.level)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    # count kolejnych kluczy od pozycji offset
+    def slice(self, offset, count):
+        if offset >= self.size:
+            return []
+        node = self.head
+        remaining = offset + 1
+        for level in reversed(range(self.level)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        keys = []
+        while node is not None and node is not self.head and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+# Globalny ranking: aktualizowany przy każdym podliczeniu głosów, bez sortowania wszystkiego.
+# key sprowadza nazwy do postaci z magazynu wyników (np. bez wielkich liter)
+class Leaderboard:
+    def __init__(self, entries=(), key=None):
+        self.lock = threading.Lock()
+        self.key = key or (lambda name: name)
+        self.scores = {}
+        # Klucz (-wynik, nazwa): najlepsi na początku, remisy alfabetycznie
+        self.ranking = SkipList()
+        for name, score in entries:
+            self.scores[self.key(name)] = score
+        self.ranking.build(sorted((-score, name) for name, score in self.scores.items()))
+
+    def update(self, name, score):
+        name = self.key(name)
+        with self.lock:
+            if name in self.scores:
+                self.ranking.remove((-self.scores[name], name))
+            self.scores[name] = score
+            self.ranking.insert((-score, name))
+
+    # Lista [miejsce, nazwa, wynik] od miejsca offset + 1
+    def top(self, count, offset=0):
+        with self.lock:
+            keys = self.ranking.slice(offset, count)
+        return [[offset + i + 1, name, -score] for i, (score, name) in enumerate(keys)]
+
+    # (miejsce, wynik) albo None, gdy gracz nie ma jeszcze wyniku
+    def rank(self, name):
+        name = self.key(name)
+        with self.lock:
+            if name not in self.scores:
+                return None
+            score = self.scores[name]
+            return self.ranking.index((-score, name)) + 1, score
+
+    def __len__(self):
+        return len(self.scores)
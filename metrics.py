@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import threading
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Progi histogramów czasu w sekundach
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def format_labels(names, values, extra=""):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Metryka z etykietami: metric.labels("game") zwraca (i zapamiętuje) konkretną serię
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.child())
+        return child
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        for values, child in list(self.children.items()):
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+
+class CounterValue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self, name, labelnames, values):
+        return ["{}{} {}".format(name, format_labels(labelnames, values), self.value)]
+
+
+class Counter(Metric):
+    kind = "counter"
+    child = CounterValue
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+# Wartość chwilowa; może być liczona dopiero przy odczycie (set_function)
+class GaugeValue:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self, name, labelnames, values):
+        value = self.function() if self.function is not None else self.value
+        return ["{}{} {}".format(name, format_labels(labelnames, values), value)]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    child = GaugeValue
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+
+class HistogramValue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, labelnames, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                name, format_labels(labelnames, values, 'le="{}"'.format(bound)), cumulative))
+        lines.append("{}_sum{} {}".format(name, format_labels(labelnames, values), total))
+        lines.append("{}_count{} {}".format(name, format_labels(labelnames, values), cumulative))
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    child = HistogramValue
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self.register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=()):
+        return self.register(Gauge(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=()):
+        return self.register(Histogram(name, description, labelnames))
+
+    # Format tekstowy Prometheusa
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Metryki serwera
+messages = REGISTRY.histogram(
+    "aphorism_message_seconds", "Time spent handling one client message, by phase", ["state"])
+serialize = REGISTRY.histogram(
+    "aphorism_serialize_seconds", "Time spent encoding one outgoing message, by encoding", ["encoding"])
+sent_bytes = REGISTRY.counter(
+    "aphorism_sent_bytes_total", "Bytes queued for clients, by negotiated encoding", ["encoding"])
+broadcast = REGISTRY.histogram(
+    "aphorism_broadcast_seconds", "Time spent fanning one message out to a room")
+recipients = REGISTRY.counter(
+    "aphorism_broadcast_recipients_total", "Frames queued by broadcasts")
+queue_depth = REGISTRY.gauge(
+    "aphorism_send_queue_bytes", "Bytes waiting in outbound buffers across all connections")
+rounds = REGISTRY.histogram(
+    "aphorism_round_seconds", "Duration of a full round from the title to the results")
+connections = REGISTRY.gauge(
+    "aphorism_connections", "Open client connections")
+rooms = REGISTRY.gauge(
+    "aphorism_rooms", "Rooms in the lobby")
+spectators = REGISTRY.gauge(
+    "aphorism_spectators", "Connections watching a room without playing")
+reaped = REGISTRY.counter(
+    "aphorism_reaped_connections_total", "Connections closed for silence, by reason", ["reason"])
+rejected = REGISTRY.counter(
+    "aphorism_rejected_messages_total", "Client messages dropped before handling, by reason", ["reason"])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Bez logowania każdego scrape'a na stdout
+    def log_message(self, format, *args):
+        pass
+
+
+# Endpoint /metrics w osobnym wątku, niezależnie od trybu serwera
+def serve(host, port):
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    print('Metrics at http://{}:{}/metrics'.format(host, port))
+    return http_server
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import collections
+
+import metrics
+
+# Co robić z klientem, który nie nadąża z odbiorem
+DROP = "drop"
+DISCONNECT = "disconnect"
+POLICIES = (DROP, DISCONNECT)
+
+# Domyślny limit bajtów czekających na wysłanie do jednego klienta
+QUEUE_LIMIT = 1024 * 1024
+
+# Rodzaje ramek stanu - nowsza zastępuje wszystkie starsze
+STATE_KINDS = ("delta", "snapshot")
+
+dropped = metrics.REGISTRY.counter(
+    "aphorism_dropped_frames_total", "Outbound frames dropped for slow clients", ["kind"])
+evicted = metrics.REGISTRY.counter(
+    "aphorism_evicted_connections_total", "Connections closed because they fell behind")
+
+
+# Ograniczona kolejka wyjściowa jednego połączenia. Broadcast tylko dokłada
+# ramkę, a wysyła osobny wątek/zadanie - więc koszt broadcastu nie zależy od
+# najwolniejszego klienta. Synchronizacja jest po stronie połączenia.
+class OutboundQueue:
+    def __init__(self, limit=QUEUE_LIMIT, policy=DROP, snapshot=None):
+        self.frames = collections.deque()
+        self.size = 0
+        self.limit = limit
+        self.policy = policy
+        # Funkcja zwracająca ramkę z aktualnym snapshotem (albo None)
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.frames)
+
+    # Zwraca False, gdy klienta trzeba rozłączyć
+    def push(self, frame, kind=None):
+        if kind == "snapshot":
+            self.drop_state()
+        elif self.size + len(frame) > self.limit:
+            if self.policy == DISCONNECT:
+                evicted.inc()
+                return False
+            # Zaległe delty są nieaktualne - zastępuje je jeden świeży snapshot,
+            # który zawiera już też tę ramkę; ponad limit może być tylko on
+            discarded = self.drop_state()
+            if kind in STATE_KINDS and self.snapshot is not None:
+                dropped.labels(kind).inc()
+                frame = self.snapshot()
+                kind = "snapshot"
+            else:
+                # Odpowiedź też zwalnia miejsce z delt, ale klient nie może zostać przy starym stanie
+                if discarded and self.snapshot is not None:
+                    self.append(self.snapshot(), "snapshot")
+                if self.size + len(frame) > self.limit:
+                    dropped.labels(kind or "reply").inc()
+                    return True
+        self.append(frame, kind)
+        return True
+
+    def append(self, frame, kind):
+        if frame is None:
+            return
+        self.frames.append((frame, kind))
+        self.size += len(frame)
+
+    # Usuwa z kolejki ramki stanu; True, gdy jakaś była
+    def drop_state(self):
+        if not any(kind in STATE_KINDS for _, kind in self.frames):
+            return False
+        kept = collections.deque()
+        for frame, kind in self.frames:
+            if kind in STATE_KINDS:
+                dropped.labels(kind).inc()
+                self.size -= len(frame)
+            else:
+                kept.append((frame, kind))
+        self.frames = kept
+        return True
+
+    # Wszystko naraz, jednym zapisem do socketu
+    def pop_all(self):
+        data = b"".join(frame for frame, _ in self.frames)
+        self.frames.clear()
+        self.size = 0
+        return data
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+import threading
+import random
+import struct
+import array
+import mmap
+import json
+import os
+import re
+
+# Wbudowana pula haseł - gdy nie ma korpusu albo filtr nic nie wybrał
+TITLES = [
+    "Python",
+    "3",
+    "JavaScript",
+    "Hamburger",
+    "Wieloryb",
+    "Szkoła",
+    "Uniwersytet",
+    "Remiza",
+    "Pomidor",
+    "Radość",
+    "Młot",
+    "Baran",
+    "Hiacynt",
+    "Jedzenie w samolocie",
+    "Rozpacz",
+    "Ciasto",
+    "Słońce",
+    "Pantofel",
+    "Widmo",
+    "Dama",
+    "Krawędź",
+    "Japonki",
+    "Zamek",
+    "Szmalcownik",
+    "Bazy danych",
+    "Szarada",
+    "Głaz",
+    "Piwnica",
+    "Pióro",
+    "Rachunek prawdopodobieństwa",
+    "Jabłko",
+    "Granat",
+    "Przystań",
+    "Sumo",
+    "Baba",
+    "Tygrys",
+    "Staw",
+    "Oliwa",
+    "Grzebień",
+    "Kuba",
+    "Piła",
+    "Polka",
+    "Warta",
+    "Róża",
+    "Kosa",
+    "Narcyz",
+    "Zebra",
+    "Kapelusz",
+    "Kule",
+    "Mars",
+    "Kiwi",
+    "Mysz"
+]
+
+# Nagłówek pliku indeksu: znacznik, rozmiar i czas modyfikacji korpusu,
+# z którego indeks zbudowano; dalej offsety początków linii (uint64)
+INDEX_HEADER = struct.Struct("<4sxxxxQQ")
+INDEX_MAGIC = b"APX1"
+
+# Ile offsetów trzymać w pamięci przy budowaniu indeksu, zanim trafią do pliku
+WRITE_CHUNK = 1 << 16
+
+# Wartości filtrów trafiają do nazw plików indeksu
+FILTER_VALUE = re.compile(r"^[\w-]{1,32}$")
+
+
+# Linie korpusu widziane jak lista: tekst czytany z mmapa dopiero przy dostępie
+class Lines:
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        start = self.offsets[index]
+        end = self.data.find(b"\n", start)
+        if end < 0:
+            end = len(self.data)
+        return fields(self.data[start:end])[0]
+
+
+# Linia korpusu: hasło<TAB>kategoria<TAB>język, dwa ostatnie pola opcjonalne
+def fields(line):
+    parts = line.decode('utf8', 'replace').rstrip("\r").split("\t")
+    parts += [""] * (3 - len(parts))
+    return [part.strip() for part in parts[:3]]
+
+
+# Korpus haseł w pliku tekstowym. Plik i indeks linii są mapowane do pamięci,
+# więc start i zużycie pamięci nie zależą od liczby haseł; indeks jest budowany
+# raz i leży obok korpusu jako PATH.idx (z filtrem: PATH.KATEGORIA.JĘZYK.idx)
+class Corpus:
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.stamp = (stat.st_size, stat.st_mtime_ns)
+        # Pustego pliku nie da się zmapować
+        self.data = b""
+        if stat.st_size:
+            with open(path, 'rb') as corpus_file:
+                self.data = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.lines = Lines(self.data, self.load_index(path + ".idx", self.scan))
+        self.categories, self.languages = self.load_values(path + ".filters")
+
+    # Offsety niepustych linii, które nie są komentarzem
+    def scan(self):
+        data = self.data
+        position = 0
+        size = len(data)
+        while position < size:
+            end = data.find(b"\n", position)
+            if end < 0:
+                end = size
+            line = data[position:end].strip()
+            if line and not line.startswith(b"#"):
+                yield position
+            position = end + 1
+
+    def select(self, category=None, language=None):
+        if not category and not language:
+            return self.lines
+        if not self.known(category, language):
+            raise ValueError("bad prompt filter {!r}".format((category, language)))
+        index_path = "{}.{}.{}.idx".format(self.path, category or "", language or "")
+
+        def matching():
+            for offset in self.lines.offsets:
+                _, line_category, line_language = fields(self.line(offset))
+                if category and line_category != category:
+                    continue
+                if language and line_language != language:
+                    continue
+                yield offset
+        return Lines(self.data, self.load_index(index_path, matching))
+
+    # Filtr z wartościami, które występują w korpusie - innym nie ma po co przeglądać pliku
+    def known(self, category=None, language=None):
+        return (not category or category in self.categories) and (not language or language in self.languages)
+
+    # Kategorie i języki korpusu, liczone raz i zapisane obok niego jak indeks
+    def load_values(self, values_path):
+        try:
+            with open(values_path, encoding='utf8') as values_file:
+                saved = json.load(values_file)
+            if saved["stamp"] == list(self.stamp):
+                return set(saved["categories"]), set(saved["languages"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        categories, languages = set(), set()
+        for offset in self.lines.offsets:
+            _, category, language = fields(self.line(offset))
+            # Wartości spoza FILTER_VALUE nie mogą trafić do nazwy pliku indeksu
+            if FILTER_VALUE.match(category):
+                categories.add(category)
+            if FILTER_VALUE.match(language):
+                languages.add(language)
+        temp = values_path + ".tmp"
+        try:
+            with open(temp, 'w', encoding='utf8') as values_file:
+                json.dump({"stamp": list(self.stamp), "categories": sorted(categories),
+                           "languages": sorted(languages)}, values_file, ensure_ascii=False)
+            os.replace(temp, values_path)
+        except OSError:
+            pass
+        return categories, languages
+
+    def line(self, start):
+        end = self.data.find(b"\n", start)
+        return self.data[start:end if end >= 0 else len(self.data)]
+
+    # Indeks z pliku, jeśli pasuje do obecnego korpusu; inaczej budowany od nowa
+    def load_index(self, index_path, offsets):
+        try:
+            return self.map_index(index_path)
+        except (OSError, ValueError, struct.error):
+            pass
+        try:
+            self.write_index(index_path, offsets())
+            return self.map_index(index_path)
+        except OSError:
+            # Katalog tylko do odczytu - indeks zostaje w pamięci
+            return array.array('Q', offsets())
+
+    def map_index(self, index_path):
+        with open(index_path, 'rb') as index_file:
+            index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, mtime = INDEX_HEADER.unpack_from(index)
+        if magic != INDEX_MAGIC or (size, mtime) != self.stamp:
+            index.close()
+            raise ValueError("stale index")
+        return memoryview(index)[INDEX_HEADER.size:].cast('Q')
+
+    # Zapis przez plik tymczasowy, żeby przerwane budowanie nie zostawiło złego indeksu
+    def write_index(self, index_path, offsets):
+        temp = index_path + ".tmp"
+        with open(temp, 'wb') as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, *self.stamp))
+            chunk = array.array('Q')
+            for offset in offsets:
+                chunk.append(offset)
+                if len(chunk) == WRITE_CHUNK:
+                    chunk.tofile(index_file)
+                    chunk = array.array('Q')
+            chunk.tofile(index_file)
+        os.replace(temp, index_path)
+
+
+def mix(value, key):
+    value = (value ^ key) * 0x9E3779B1 & 0xFFFFFFFF
+    value ^= value >> 16
+    value = value * 0x85EBCA6B & 0xFFFFFFFF
+    return value ^ (value >> 13)
+
+
+# Losowa permutacja 0..size-1 bez tablicy: sieć Feistela na najbliższej parzystej
+# liczbie bitów, a wyniki spoza zakresu przechodzą przez nią jeszcze raz
+class Permutation:
+    ROUNDS = 4
+
+    def __init__(self, size, rng=random):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self.half = bits // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [rng.getrandbits(32) for _ in range(self.ROUNDS)]
+
+    def __getitem__(self, index):
+        while True:
+            left, right = index >> self.half, index & self.mask
+            for key in self.keys:
+                left, right = right, left ^ (mix(right, key) & self.mask)
+            index = (left << self.half) | right
+            if index < self.size:
+                return index
+
+
+# Worek bez powtórzeń: każde hasło raz, potem nowa kolejność. Pamięć O(1)
+# niezależnie od rozmiaru puli; wywołujący trzyma lock pokoju
+class ShuffleBag:
+    def __init__(self, items, rng=random):
+        self.items = items
+        self.rng = rng
+        self.position = len(items)
+        self.permutation = None
+
+    def next(self):
+        if self.position >= len(self.items):
+            self.permutation = Permutation(len(self.items), self.rng)
+            self.position = 0
+        item = self.items[self.permutation[self.position]]
+        self.position += 1
+        return item
+
+    # Miejsce w obecnej kolejności, do snapshotu stanu serwera
+    def dump(self):
+        keys = self.permutation.keys if self.permutation is not None else None
+        return {"size": len(self.items), "position": self.position, "keys": keys}
+
+    # Ta sama kolejność po restarcie - o ile pula haseł się nie zmieniła
+    def load(self, saved):
+        if saved["keys"] is None or saved["size"] != len(self.items):
+            return
+        self.permutation = Permutation(len(self.items), self.rng)
+        self.permutation.keys = list(saved["keys"])
+        self.position = saved["position"]
+
+
+# Źródło haseł serwera: korpus z pliku albo TITLES
+class Prompts:
+    def __init__(self, path=None):
+        self.corpus = Corpus(path) if path else None
+        # Wybrane linie po filtrze, wspólne dla pokojów z tym samym filtrem
+        self.selections = {}
+        # Filtry, których indeks właśnie powstaje: kto przyjdzie po ten sam, czeka na Event
+        self.building = {}
+        self.lock = threading.Lock()
+
+    # Filtr, który może coś wybrać; bez korpusu każdy (i tak zostają TITLES)
+    def valid(self, category=None, language=None):
+        return self.corpus is None or self.corpus.known(category, language)
+
+    # Czy select zwróci linie od razu, bez budowania indeksu filtra
+    def ready(self, category=None, language=None):
+        if self.corpus is None or not (category or language):
+            return True
+        return (category or None, language or None) in self.selections
+
+    def select(self, category=None, language=None):
+        if self.corpus is None:
+            return TITLES
+        key = (category or None, language or None)
+        # Lock tylko na słowniki - przeglądanie korpusu nie wstrzymuje select innych filtrów
+        while True:
+            with self.lock:
+                lines = self.selections.get(key)
+                if lines is not None:
+                    return lines if len(lines) else TITLES
+                building = self.building.get(key)
+                owner = building is None
+                if owner:
+                    building = self.building[key] = threading.Event()
+            if not owner:
+                # Po nieudanej budowie następny czekający próbuje sam
+                building.wait()
+                continue
+            try:
+                lines = self.corpus.select(*key)
+                with self.lock:
+                    self.selections[key] = lines
+            finally:
+                with self.lock:
+                    del self.building[key]
+                building.set()
+            return lines if len(lines) else TITLES
+
+    def bag(self, category=None, language=None):
+        return ShuffleBag(self.select(category, language))
+
+    def __len__(self):
+        return len(self.corpus.lines) if self.corpus is not None else len(TITLES)
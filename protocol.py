@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import struct
+import json
+import time
+import zlib
+
+# msgpack jest opcjonalny - bez niego serwer i klient zostają przy json/deflate
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Każda wiadomość to 4 bajty długości (big-endian) + treść
+HEADER = struct.Struct("!I")
+
+# Ile bajtów czytać z socketu naraz - nie ogranicza rozmiaru wiadomości
+READ_SIZE = 65536
+
+# Domyślny limit długości wiadomości od klienta; wiadomości serwera (snapshoty) go nie mają
+MAX_MESSAGE = 64 * 1024
+
+# Maksymalna liczba pozycji w jednej odpowiedzi (lista pokojów, ranking, wyszukiwanie)
+MAX_LIST = 500
+
+# Kodowania wiadomości serwera uzgadniane przy join, od najlepszego;
+# json jest zawsze dostępny i jest domyślny
+ENCODINGS = (["msgpack"] if msgpack is not None else []) + ["deflate", "json"]
+
+# Krótszych wiadomości nie opłaca się kompresować
+COMPRESS_MIN = 256
+
+
+def frame(message):
+    if isinstance(message, str):
+        message = message.encode('utf8')
+    return HEADER.pack(len(message)) + message
+
+
+# Zakres strony z polecenia klienta, przycięty do MAX_LIST
+def page(offset, limit):
+    try:
+        return max(0, int(offset)), max(0, min(int(limit), MAX_LIST))
+    # OverflowError: nieskończoność z json (1e400)
+    except (ValueError, TypeError, OverflowError):
+        return 0, MAX_LIST
+
+
+# Pierwsze kodowanie z listy klienta, które zna też serwer; cokolwiek innego niż lista to json
+def negotiate(offered):
+    if not isinstance(offered, (list, tuple)):
+        return "json"
+    for encoding in offered:
+        if encoding in ENCODINGS:
+            return encoding
+    return "json"
+
+
+# Treść wiadomości w danym kodowaniu; text to gotowy json w bajtach, jeśli już jest
+def dumps(message, encoding="json", text=None):
+    if encoding == "msgpack":
+        return msgpack.packb(message, use_bin_type=True)
+    if text is None:
+        text = json.dumps(message, ensure_ascii=False).encode('utf8')
+    if encoding == "deflate":
+        # Pierwszy bajt mówi, czy reszta jest skompresowana
+        if len(text) < COMPRESS_MIN:
+            return b"\x00" + text
+        return b"\x01" + zlib.compress(text, 1)
+    return text
+
+
+def loads(data, encoding="json"):
+    if encoding == "msgpack":
+        return msgpack.unpackb(data, raw=False)
+    if encoding == "deflate":
+        data = zlib.decompress(data[1:]) if data[:1] == b"\x01" else data[1:]
+    return json.loads(data)
+
+
+# Przyrostowy dekoder strumienia: jeden recv może zawierać kilka wiadomości
+# albo tylko kawałek jednej, więc niepełne dane czekają w buforze
+class Decoder:
+    # limit: największa dopuszczalna długość wiadomości, None = bez limitu
+    def __init__(self, limit=None):
+        self.buffer = bytearray()
+        self.limit = limit
+        # Od kiedy w buforze czeka niepełna wiadomość (time.monotonic), None gdy pusty
+        self.since = None
+
+    # Zwraca treści kompletnych wiadomości jako bajty
+    def feed(self, chunk):
+        self.buffer += chunk
+        messages = []
+        offset = 0
+        end = len(self.buffer)
+        while end - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            # Za długa wiadomość jest odrzucana już po nagłówku, zanim trafi do bufora
+            if self.limit is not None and length > self.limit:
+                raise ValueError("message of {} bytes over the limit".format(length))
+            start = offset + HEADER.size
+            if end - start < length:
+                break
+            # Dekodujemy dopiero całą wiadomość, więc znaki UTF-8 nie są ucinane
+            messages.append(bytes(self.buffer[start:start + length]))
+            offset = start + length
+        if offset:
+            del self.buffer[:offset]
+        if not self.buffer:
+            self.since = None
+        elif offset or self.since is None:
+            self.since = time.monotonic()
+        return messages
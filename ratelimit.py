@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+# Domyślne limity wiadomości od klientów: na sekundę i ile można wysłać naraz
+RATE = 20
+BURST = 40
+# Wszystkie połączenia z jednego adresu razem
+IP_RATE = 1000
+IP_BURST = 2000
+
+
+# Kubełek żetonów: rate żetonów na sekundę, najwyżej burst w zapasie.
+# Liczony leniwie przy take, więc nie potrzebuje żadnego timera
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # Kubełek adresu dzielą wątki kilku połączeń
+        self.lock = threading.Lock()
+
+    def take(self, now=None):
+        if self.rate <= 0:
+            return True
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+# Kubełki adresów IP, żyjące tak długo, jak jakieś połączenie z danego adresu
+class AddressLimits:
+    def __init__(self, rate=IP_RATE, burst=IP_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # adres -> [kubełek, liczba połączeń]
+        self.buckets = {}
+
+    def acquire(self, address):
+        with self.lock:
+            entry = self.buckets.get(address)
+            if entry is None:
+                entry = self.buckets[address] = [TokenBucket(self.rate, self.burst), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, address):
+        with self.lock:
+            entry = self.buckets.get(address)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if not entry[1]:
+                del self.buckets[address]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import asyncio
+import argparse
+import json
+
+import protocol
+import outbound
+import state
+
+# Port, na którym przekaźnik przyjmuje widzów
+RELAY_PORT = 7313
+
+# Najdłuższa przerwa między próbami połączenia z serwerem
+RETRY_MAX = 5
+
+
+# Przekaźnik dla widzów: jedno połączenie z serwerem jako widz pokoju, a dalej
+# te same bajty do wszystkich podłączonych. Ramek nie koduje od nowa - każda paczka
+# z serwera to jeden bufor zapisywany do każdego widza. Stan pokoju trzyma tylko po to,
+# żeby nowy widz dostał snapshot bez pytania serwera
+class Relay:
+    def __init__(self, server, server_port, room, encoding="json", limit=outbound.QUEUE_LIMIT):
+        self.server = server
+        self.server_port = server_port
+        self.room = room
+        self.encoding = encoding
+        self.limit = limit
+        # Widzowie: writer -> czy dostał już snapshot
+        self.watchers = {}
+        self.data = None
+        self.version = -1
+        # Ramka snapshotu bieżącej wersji, liczona przy pierwszym widzu
+        self.snapshot = None
+
+    async def upstream(self):
+        delay = 0.1
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.server, self.server_port)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+                continue
+            delay = 0.1
+            print('Watching {} at {}:{}'.format(self.room, self.server, self.server_port))
+            writer.write(protocol.frame(json.dumps({"type": "watch", "room": self.room,
+                                                    "encodings": [self.encoding]})))
+            try:
+                await self.receive(reader, writer)
+            except (ConnectionError, ValueError) as error:
+                print('Lost the server: {!r}'.format(error))
+                # Np. pokoju jeszcze nie ma - bez zasypywania serwera próbami
+                delay = RETRY_MAX
+            writer.close()
+            self.data = None
+            self.version = -1
+            self.snapshot = None
+            await asyncio.sleep(delay)
+
+    async def receive(self, reader, writer):
+        decoder = protocol.Decoder()
+        encoding = "json"
+        while True:
+            chunk = await reader.read(protocol.READ_SIZE)
+            if not chunk:
+                return
+            frames = []
+            for message in decoder.feed(chunk):
+                decoded = protocol.loads(message, encoding)
+                if decoded["type"] == "welcome":
+                    encoding = decoded["encoding"]
+                    if encoding != self.encoding:
+                        raise ValueError("server chose {}".format(encoding))
+                    continue
+                if decoded["type"] == "error":
+                    raise ValueError(decoded.get("reason"))
+                # Pingi serwera są dla przekaźnika, nie dla jego widzów
+                if decoded["type"] == "ping":
+                    writer.write(protocol.frame(json.dumps({"type": "pong"})))
+                    continue
+                if decoded["type"] == "snapshot":
+                    self.data = decoded["data"]
+                    self.version = decoded["version"]
+                elif decoded["type"] == "delta" and self.data is not None:
+                    if decoded["version"] != self.version + 1:
+                        self.data = None
+                        writer.write(protocol.frame(json.dumps({"type": "resync"})))
+                        continue
+                    state.apply(self.data, decoded["changes"], decoded["removed"])
+                    self.version = decoded["version"]
+                else:
+                    continue
+                self.snapshot = None
+                frames.append(protocol.frame(message))
+            if frames:
+                self.fan_out(b"".join(frames))
+
+    # Jeden bufor dla wszystkich; widz, który nie odbiera, jest rozłączany
+    # i przy powrocie dostanie świeży snapshot
+    def fan_out(self, data):
+        for writer, ready in list(self.watchers.items()):
+            if not ready:
+                self.send_snapshot(writer)
+            elif writer.transport.get_write_buffer_size() > self.limit:
+                self.drop(writer)
+            else:
+                writer.write(data)
+
+    def send_snapshot(self, writer):
+        if self.data is None:
+            return
+        if self.snapshot is None:
+            message = {"type": "snapshot", "version": self.version, "data": self.data,
+                       "room": self.room, "spectator": True}
+            self.snapshot = protocol.frame(protocol.dumps(message, self.encoding))
+        writer.write(self.snapshot)
+        self.watchers[writer] = True
+
+    def drop(self, writer):
+        self.watchers.pop(writer, None)
+        writer.close()
+
+    async def accept(self, reader, writer):
+        decoder = protocol.Decoder(protocol.MAX_MESSAGE)
+        try:
+            while True:
+                chunk = await reader.read(protocol.READ_SIZE)
+                if not chunk:
+                    break
+                for message in decoder.feed(chunk):
+                    request = json.loads(message)
+                    kind = request.get("type")
+                    # Powitanie jak na serwerze; gracz też dostaje tylko podgląd
+                    if kind in ("watch", "join") and writer not in self.watchers:
+                        if self.encoding != "json" and self.encoding not in (request.get("encodings") or ()):
+                            writer.write(protocol.frame(json.dumps(
+                                {"type": "error", "reason": "relay speaks {}".format(self.encoding)})))
+                            continue
+                        writer.write(protocol.frame(json.dumps({"type": "welcome", "encoding": self.encoding})))
+                        self.watchers[writer] = False
+                        self.send_snapshot(writer)
+                    elif kind == "resync" and writer in self.watchers:
+                        self.watchers[writer] = False
+                        self.send_snapshot(writer)
+        except (ConnectionError, ValueError, AttributeError):
+            pass
+        self.drop(writer)
+
+    async def serve(self, host, port):
+        relay_server = await asyncio.start_server(self.accept, host, port, reuse_address=True, backlog=1024)
+        print('Relaying at', relay_server.sockets[0].getsockname())
+        # Pętla trzyma zadania tylko słabo - bez referencji zadanie mógłby zebrać GC
+        self.task = asyncio.ensure_future(self.upstream())
+        async with relay_server:
+            await relay_server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aphorism spectator relay')
+    parser.add_argument('server', help='Address of the game server')
+    parser.add_argument('room', help='Room to relay')
+    parser.add_argument('--server-port', type=int, default=7312)
+    parser.add_argument('--host', default='0.0.0.0', help='Interface the relay listens at')
+    parser.add_argument('--port', type=int, default=RELAY_PORT)
+    parser.add_argument('--encoding', choices=protocol.ENCODINGS, default='json',
+                        help='Encoding asked from the server and passed on unchanged; '
+                             'spectators must offer it')
+    parser.add_argument('--send-queue', type=int, default=outbound.QUEUE_LIMIT,
+                        help='Bytes that may wait for one spectator before it is disconnected')
+    args = parser.parse_args()
+
+    relay = Relay(args.server, args.server_port, args.room, args.encoding, args.send_queue)
+    try:
+        asyncio.run(relay.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+
+import threading
+import itertools
+import heapq
+import random
+import json
+import time
+
+import protocol
+import metrics
+import dedup
+from state import GameState
+from audience import Audience
+
+# Liczba graczy potrzebna do rozpoczęcia
+MIN_PLAYERS = 3
+
+# Duży pokój: każdy dostaje tylko stronę kartek do głosowania, a nie wszystkie teksty
+BALLOT_SIZE = 20
+# Ile najlepszych tekstów pokazywać w wynikach na żywo i na końcu rundy dużego pokoju
+LEADERS = 10
+# Co ile sekund rozsyłać wyniki na żywo w trakcie głosowania w dużym pokoju
+PARTIAL_INTERVAL = 1.0
+
+# Najdłuższy przyjmowany aforyzm w znakach (klient pozwala na 100)
+MAX_TEXT = 500
+
+
+# Wiadomość do wysłania: każde kodowanie liczone najwyżej raz na broadcast,
+# a ta sama ramka trafia do wszystkich klientów z tym kodowaniem
+class Payload:
+    def __init__(self, message):
+        self.message = message
+        self.text = None
+        self.frames = {}
+
+    def frame(self, encoding="json"):
+        frame = self.frames.get(encoding)
+        if frame is None:
+            start = time.perf_counter()
+            if encoding != "msgpack" and self.text is None:
+                self.text = json.dumps(self.message, ensure_ascii=False).encode('utf8')
+            frame = self.frames[encoding] = protocol.frame(protocol.dumps(self.message, encoding, self.text))
+            metrics.serialize.labels(encoding).observe(time.perf_counter() - start)
+        return frame
+
+
+def encode(message):
+    return Payload(message)
+
+
+# Jeden pokój = jedna gra z własnym stanem, hasłem, głosami i listą połączeń
+class Room:
+    def __init__(self, name, server, category=None, language=None):
+        self.name = name
+        self.server = server
+        # Hasła bez powtórzeń, z filtrem wybranym przy tworzeniu pokoju
+        self.category = category
+        self.language = language
+        self.prompts = server.prompts.bag(category, language)
+        # id -> połączenie, żeby usuwanie i szukanie było O(1)
+        self.connections = {}
+        # Widzowie - osobno, bo nie są graczami
+        self.audience = Audience(self)
+        # Pokoje działają niezależnie, więc każdy ma własny lock
+        self.lock = threading.RLock()
+        # Init ustawień
+        self.data = {}
+        self.data["title"] = "undefined"
+        self.data["state"] = "wait"
+        self.data["users"] = {}
+        self.data["messages"] = {}
+        self.data["scores"] = {}
+        self.data["total_scores"] = {}
+        # Gracz -> podobieństwo jego tekstu do wcześniejszego, widoczne przy głosowaniu
+        self.data["duplicates"] = {}
+        # Duży pokój: czy runda jest w tym trybie i czołówka głosowania na żywo
+        self.data["large"] = False
+        self.data["leaders"] = []
+        self.votes = {}
+        # Głosy liczone na bieżąco: gracz -> liczba głosów na jego tekst
+        self.counts = {}
+        # Sumy punktów wszystkich graczy; w stanie wspólnym dużego pokoju jest tylko czołówka
+        self.totals = {}
+        # Duży pokój: wszystkie teksty rundy poza stanem wspólnym (już od ich wysłania,
+        # żeby join w trakcie pisania nie rozsyłał ich wszystkim), kolejność kartek
+        # i czy od ostatniego rozesłania czołówki przyszły głosy
+        self.texts = {}
+        self.ballot_order = []
+        self.counts_changed = False
+        # Gracz -> id jego tekstu z tej rundy w indeksie podobieństwa
+        self.submissions = {}
+        self.state = GameState(self.data)
+        # Termin końca obecnej fazy i jej numer - stare timery są ignorowane
+        self.deadline = None
+        self.phase = 0
+        # Początek obecnej rundy, do metryki czasu rund
+        self.round_start = None
+
+    def new_round(self):
+        with self.lock:
+            print("New round in {}".format(self.name))
+            self.votes = {}
+            self.counts = {}
+            self.texts = {}
+            self.ballot_order = []
+            self.submissions = {}
+            self.data["scores"] = {}
+            self.data["messages"] = {}
+            self.data["duplicates"] = {}
+            self.data["large"] = False
+            self.data["leaders"] = []
+            self.data["title"] = self.prompts.next()
+            # Stan zależny od liczby graczy
+            if self.player_count() >= MIN_PLAYERS:
+                self.set_state("game")
+            else:
+                self.set_state("wait")
+            self.publish()
+
+    # Zmiana fazy razem z jej terminem; timer nigdy nie blokuje obsługi połączeń
+    def set_state(self, state):
+        self.data["state"] = state
+        self.phase += 1
+        if state == "game":
+            self.round_start = time.perf_counter()
+        elif state == "display" and self.round_start is not None:
+            metrics.rounds.observe(time.perf_counter() - self.round_start)
+            self.round_start = None
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        timeout = self.server.timeouts.get(state)
+        if timeout is not None:
+            self.deadline = self.server.scheduler.call_later(timeout, self.expire, self.phase)
+
+    # Faza minęła: idziemy dalej z tym, co gracze zdążyli wysłać
+    def expire(self, phase):
+        with self.lock:
+            if phase != self.phase:
+                return
+            self.deadline = None
+            state = self.data["state"]
+            if state == "display":
+                self.new_round()
+            elif state == "game":
+                if self.submitted():
+                    self.start_vote()
+                else:
+                    # Nikt nic nie napisał - nowe hasło
+                    self.new_round()
+            elif state == "vote":
+                self.tally()
+
+    # Teksty wysłane w tej rundzie, w stanie wspólnym i poza nim
+    def submitted(self):
+        return len(self.data["messages"]) + len(self.texts)
+
+    # Bariery faz po zmianie liczby graczy - wyjście gracza może zamknąć fazę
+    def advance(self):
+        data = self.data
+        if data["state"] == "game" and self.submitted() and self.submitted() >= self.player_count():
+            self.start_vote()
+        elif data["state"] == "vote" and self.votes and len(self.votes) >= self.player_count():
+            self.tally()
+
+    # Od pewnej liczby graczy teksty nie idą do wszystkich: zostają w pokoju, a każdy
+    # dostaje własną stronę kartek; czołówka głosowania jest rozsyłana co PARTIAL_INTERVAL
+    def start_vote(self):
+        data = self.data
+        self.set_state("vote")
+        # Liczba graczy mogła się zmienić w trakcie pisania - teksty idą tam, gdzie pasują teraz
+        if self.player_count() >= self.server.large_room:
+            data["large"] = True
+            self.texts.update(data["messages"])
+            data["messages"] = {}
+            self.ballot_order = list(self.texts)
+            random.shuffle(self.ballot_order)
+            self.server.scheduler.call_later(PARTIAL_INTERVAL, self.publish_partial, self.phase)
+        else:
+            data["messages"].update(self.texts)
+            self.texts = {}
+        self.publish()
+        if data["large"]:
+            for position, connection in enumerate(self.connections.values()):
+                # Każdy zaczyna w innym miejscu kolejki, więc teksty trafiają na podobną liczbę kartek
+                self.send_ballot(connection, position * BALLOT_SIZE)
+
+    # Strona kartek gracza: BALLOT_SIZE cudzych tekstów od offset w kolejności rundy (w kółko)
+    def send_ballot(self, connection, offset=0):
+        order = self.ballot_order
+        entries = []
+        taken = 0
+        if order:
+            offset %= len(order)
+            for player in itertools.islice(itertools.chain(order[offset:], order[:offset]), BALLOT_SIZE + 1):
+                if len(entries) == BALLOT_SIZE:
+                    break
+                taken += 1
+                if player != connection.id:
+                    entries.append([player, self.texts[player]])
+        connection.send(encode({"type": "ballot", "offset": offset, "next": offset + taken,
+                                "total": len(order), "entries": entries}))
+
+    def publish_partial(self, phase):
+        with self.lock:
+            if phase != self.phase:
+                return
+            if self.counts_changed:
+                self.counts_changed = False
+                self.data["leaders"] = self.leaders()
+                self.publish()
+            self.server.scheduler.call_later(PARTIAL_INTERVAL, self.publish_partial, phase)
+
+    # Czołówka [gracz, nazwa, głosy] prosto z liczników - bez przeliczania wszystkich głosów
+    def leaders(self):
+        users = self.data["users"]
+        return [[player, users.get(player, ""), votes]
+                for player, votes in heapq.nlargest(LEADERS, self.counts.items(), key=lambda item: item[1])]
+
+    # Głos liczony od razu; zmiana głosu cofa poprzedni
+    def count_vote(self, voter, player):
+        previous = self.votes.get(voter)
+        if previous is not None:
+            self.counts[previous] -= 1
+            if not self.counts[previous]:
+                del self.counts[previous]
+        self.votes[voter] = player
+        self.counts[player] = self.counts.get(player, 0) + 1
+        self.counts_changed = True
+
+    def join(self, connection):
+        data = self.data
+        self.connections[connection.id] = connection
+        connection.room = self
+        data["users"][connection.id] = connection.username
+        # Zmień stan, gdy jest już wystarczająca liczba graczy
+        if len(data["users"]) >= MIN_PLAYERS and data["state"] == "wait":
+            data["title"] = self.prompts.next()
+            self.set_state("game")
+        # Pozostali dostają tylko deltę, nowy gracz pełny snapshot
+        self.publish(connection)
+        self.send_snapshot(connection)
+
+    def handle(self, connection, kind, request):
+        data = self.data
+        # Klient zgubił wersję stanu i prosi o pełny snapshot
+        if kind == "resync":
+            self.send_snapshot(connection)
+        # Klient wysłał aforyzm
+        elif kind == "submit" and data["state"] == "game":
+            text = str(request.get("text", ""))
+            if len(text) > MAX_TEXT:
+                metrics.rejected.labels("text").inc()
+                return
+            if not self.check_duplicate(connection, text):
+                return
+            if self.player_count() >= self.server.large_room:
+                data["messages"].pop(connection.id, None)
+                self.texts[connection.id] = text
+            else:
+                self.texts.pop(connection.id, None)
+                data["messages"][connection.id] = text
+            # Zmień stan, gdy wszyscy wysłali
+            self.advance()
+        # Klient głosuje
+        elif kind == "vote" and data["state"] == "vote":
+            try:
+                player = int(request.get("player"))
+            except (ValueError, TypeError, OverflowError):
+                return
+            # Tylko na istniejący cudzy tekst - inaczej dowolne id trafiłoby do wyników i snapshotu
+            texts = self.texts if data["large"] else data["messages"]
+            if player not in texts or player == connection.id:
+                return
+            self.count_vote(connection.id, player)
+            self.advance()
+        # Kolejna strona kartek w dużym pokoju
+        elif kind == "ballot" and data["state"] == "vote" and data["large"]:
+            try:
+                offset = int(request.get("offset", 0))
+            except (ValueError, TypeError, OverflowError):
+                return
+            self.send_ballot(connection, offset)
+
+    # Tekst podobny do wcześniejszego (z historii albo tej rundy) jest oznaczany albo
+    # odrzucany; False = nie przyjmować. Poprzedni tekst gracza z tej rundy jest zastępowany
+    def check_duplicate(self, connection, text):
+        index = self.server.similar
+        if index is None:
+            return True
+        previous = self.submissions.get(connection.id)
+        match = index.find(text, ignore=previous)
+        if match is not None:
+            similarity, similar = match
+            rejected = self.server.duplicates == dedup.REJECT
+            dedup.found.labels("rejected" if rejected else "flagged").inc()
+            connection.send(encode({"type": "duplicate", "similar": similar,
+                                    "similarity": round(similarity, 2), "rejected": rejected}))
+            if rejected:
+                return False
+            self.data["duplicates"][connection.id] = round(similarity, 2)
+        else:
+            self.data["duplicates"].pop(connection.id, None)
+        if previous is not None:
+            index.remove(previous)
+        self.submissions[connection.id] = index.add(text)
+        return True
+
+    # Rozesłanie zmian od ostatniej wersji; delta kodowana raz dla wszystkich
+    def publish(self, source=None):
+        delta = self.state.commit()
+        if delta is None:
+            return
+        payload = encode(delta)
+        if source is None:
+            self.broadcast_all(payload)
+        else:
+            self.broadcast(payload, source)
+        # Ta sama zakodowana delta idzie do widzów
+        self.audience.push(payload)
+
+    def send_snapshot(self, connection):
+        connection.send(self.snapshot_payload(connection), "snapshot")
+        # Kartki i wynik gracza w dużym pokoju nie są częścią stanu, więc idą osobno
+        if self.data["large"]:
+            if self.data["state"] == "vote":
+                self.send_ballot(connection)
+            elif self.data["state"] == "display":
+                self.send_score(connection)
+
+    def snapshot_payload(self, connection):
+        if connection.watching is self:
+            return encode(self.state.snapshot(room=self.name, spectator=True))
+        return encode(self.state.snapshot(playerid=connection.id, room=self.name))
+
+    def tally(self):
+        data = self.data
+        scores = self.server.scores
+        texts = self.texts if data["large"] else data["messages"]
+        # Głosy są już policzone przy przyjściu
+        if data["large"]:
+            # Do wszystkich idą tylko teksty i wyniki czołówki - reszta gracza idzie do niego
+            data["leaders"] = self.leaders()
+            data["messages"] = {player: texts[player] for player, _, _ in data["leaders"] if player in texts}
+            data["scores"] = {player: votes for player, _, votes in data["leaders"]}
+        else:
+            data["scores"] = dict(self.counts)
+        # Naokoło dodawanie ich do totala oraz do magazynu wyników
+        # Magazyn jest osobno, bo jeśli są name clashe, to istnieją dwa total_scores i jeden wpis w magazynie
+        missing = []
+        for player, points in self.counts.items():
+            if player not in data["users"]:
+                continue
+            name = data["users"][player]
+            if player not in self.totals:
+                self.totals[player] = 0
+                missing.append((player, name, points))
+            self.totals[player] += points
+            total = scores.add(name, points)
+            self.server.leaderboard.update(name, total)
+        self.show_totals()
+        # Runda trafia do archiwum: każdy tekst z autorem i liczbą głosów
+        if self.server.archive is not None:
+            self.server.archive.add(self.name, data["title"], [
+                (data["users"].get(player, ""), text, self.counts.get(player, 0))
+                for player, text in texts.items()])
+        # Zmiana stanu na display, kolejna runda po czasie z harmonogramu
+        self.set_state("display")
+        self.publish()
+        if data["large"]:
+            for connection in self.connections.values():
+                self.send_score(connection)
+        if missing:
+            self.fetch_totals(missing)
+
+    # Sumy w stanie wspólnym: w dużym pokoju tylko czołówki, żeby delta nie rosła z pokojem
+    def show_totals(self):
+        if self.data["large"]:
+            self.data["total_scores"] = {player: self.totals[player]
+                                         for player, _, _ in self.data["leaders"] if player in self.totals}
+        else:
+            self.data["total_scores"] = dict(self.totals)
+
+    # Wynik gracza z rundy dużego pokoju i jego suma - tylko do niego
+    def send_score(self, connection):
+        connection.send(encode({"type": "score", "score": self.counts.get(connection.id, 0),
+                                "total": self.totals.get(connection.id, 0)}))
+
+    # Wcześniejsze sumy nowych graczy. Magazyn może być w innym procesie, więc pytamy go
+    # w tle, a nie pod lockiem pokoju; odpowiedź zawiera już punkty tej rundy
+    def fetch_totals(self, missing):
+        scores = self.server.scores
+
+        def apply(totals):
+            with self.lock:
+                for player, points, total in totals:
+                    if player in self.totals:
+                        self.totals[player] += total - points
+                self.show_totals()
+                self.publish()
+                if self.data["large"] and self.data["state"] == "display":
+                    for player, _, _ in totals:
+                        if player in self.connections:
+                            self.send_score(self.connections[player])
+        self.server.background(apply, lambda: [(player, points, scores.get(name)) for player, name, points in missing])
+
+    # Powrót gracza po zerwaniu połączenia: jego dane zostały w pokoju, więc
+    # zamiast ścieżki join wystarczy jeden snapshot dla niego
+    def resume(self, connection, previous=None):
+        if previous is not None and self.connections.get(previous.id) is previous:
+            del self.connections[previous.id]
+            previous.room = None
+        self.connections[connection.id] = connection
+        connection.room = self
+        self.send_snapshot(connection)
+
+    # Wyjście z pokoju na dobre
+    def leave(self, connection):
+        self.forget(connection.id)
+        self.detach(connection)
+
+    # Połączenie znika z pokoju, ale dane gracza zostają do forget
+    def detach(self, connection):
+        if self.connections.get(connection.id) is connection:
+            del self.connections[connection.id]
+        connection.room = None
+        self.settle()
+
+    # Usunięcie gracza z danych pokoju
+    def forget(self, player):
+        self.data["users"].pop(player, None)
+        self.data["messages"].pop(player, None)
+        # Przy głosowaniu tekst zostaje na kartkach
+        if self.data["state"] == "game":
+            self.texts.pop(player, None)
+        self.data["scores"].pop(player, None)
+        self.data["total_scores"].pop(player, None)
+        self.totals.pop(player, None)
+        self.data["duplicates"].pop(player, None)
+        # Głos wychodzącego gracza przestaje się liczyć, dopóki głosowanie trwa
+        voted = self.votes.pop(player, None)
+        if voted is not None and self.data["state"] == "vote":
+            self.counts[voted] -= 1
+            if not self.counts[voted]:
+                del self.counts[voted]
+            self.counts_changed = True
+
+    # Odłączeni gracze nie wstrzymują barier; bez żadnych graczy pokój czeka.
+    # Pozostali dostają deltę także wtedy, gdy zmieniła się tylko lista graczy
+    def settle(self):
+        if not self.data["users"]:
+            self.set_state("wait")
+        elif self.connections:
+            self.advance()
+        self.publish()
+
+    # Wiadomości są już zakodowane w ramki, więc kodowanie jest raz na broadcast
+    def broadcast(self, message, source):
+        start = time.perf_counter()
+        for connection in self.connections.values():
+            # Wyślij wiadomość do wszystkich oprócz source
+            if connection is not source:
+                connection.send(message, "delta")
+        metrics.broadcast.observe(time.perf_counter() - start)
+        metrics.recipients.inc(len(self.connections) - 1)
+
+    def broadcast_all(self, message):
+        start = time.perf_counter()
+        for connection in self.connections.values():
+            connection.send(message, "delta")
+        metrics.broadcast.observe(time.perf_counter() - start)
+        metrics.recipients.inc(len(self.connections))
+
+    def player_count(self):
+        return len(self.connections)
+
+    # Stan pokoju do snapshotu serwera; słowniki po id graczy jako listy par
+    def dump(self):
+        data = self.data
+        pairs = lambda mapping: [[key, value] for key, value in mapping.items()]
+        return {"name": self.name, "category": self.category, "language": self.language,
+                "title": data["title"], "state": data["state"], "version": self.state.version,
+                # Ostatnio rozesłany stan - teksty niewidoczne jeszcze dla graczy nie mogą wyjść w snapshocie
+                "published": self.state.published,
+                "users": pairs(data["users"]), "messages": pairs(data["messages"]),
+                "scores": pairs(data["scores"]), "total_scores": pairs(self.totals),
+                "duplicates": pairs(data["duplicates"]), "large": data["large"],
+                "leaders": [list(leader) for leader in data["leaders"]],
+                "votes": pairs(self.votes), "counts": pairs(self.counts), "texts": pairs(self.texts),
+                "ballot_order": list(self.ballot_order), "prompts": self.prompts.dump()}
+
+    # Odtworzenie pokoju ze snapshotu; terminy faz liczone od nowa, bo zegar sprzed restartu nic nie znaczy
+    def load(self, saved):
+        data = self.data
+        data["title"] = saved["title"]
+        for key in ("users", "messages", "scores", "duplicates"):
+            data[key] = dict(saved[key])
+        data["large"] = saved["large"]
+        data["leaders"] = saved["leaders"]
+        self.totals = dict(saved["total_scores"])
+        self.show_totals()
+        self.votes = dict(saved["votes"])
+        self.counts = dict(saved["counts"])
+        self.texts = dict(saved["texts"])
+        self.ballot_order = saved["ballot_order"]
+        self.prompts.load(saved["prompts"])
+        data["state"] = saved["state"]
+        # self.state patrzy na ten sam słownik data - wystarczy mu wersja i ostatnio rozesłany stan
+        self.state.version = saved["version"]
+        self.state.published = saved["published"]
+        self.set_state(saved["state"])
+        if data["state"] == "vote" and data["large"]:
+            self.server.scheduler.call_later(PARTIAL_INTERVAL, self.publish_partial, self.phase)
+
+    def info(self):
+        return {"name": self.name, "players": self.player_count(), "spectators": len(self.audience),
+                "state": self.data["state"],
+                "category": self.category, "language": self.language}
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import threading
+import itertools
+import heapq
+import time
+
+
+# Zaplanowane wywołanie; anulowanie tylko je oznacza, z kopca wypada przy pobraniu
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+# Jeden wątek z kopcem terminów dla wszystkich pokojów - zamiast sleep w wątku gracza.
+# Interfejs call_later jak w pętli asyncio, więc AsyncServer używa po prostu pętli.
+class Scheduler(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.queue = []
+        self.condition = threading.Condition()
+        # Remisy terminów rozstrzygane kolejnością dodania
+        self.counter = itertools.count()
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.condition:
+            heapq.heappush(self.queue, (timer.when, next(self.counter), timer))
+            # Budzimy wątek tylko, gdy nowy termin jest najwcześniejszy
+            if self.queue[0][2] is timer:
+                self.condition.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    when, _, timer = self.queue[0]
+                    now = time.monotonic()
+                    if when > now:
+                        self.condition.wait(when - now)
+                        continue
+                    heapq.heappop(self.queue)
+                    if not timer.cancelled:
+                        break
+            try:
+                timer.callback(*timer.args)
+            except Exception as error:
+                print("Timer callback failed: {!r}".format(error))
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+import configparser
+import threading
+import sqlite3
+import socket
+import json
+import os
+
+import protocol
+from leaderboard import Leaderboard
+
+# Co ile sekund zapisywać zebrane punkty i przy ilu graczach w kolejce zapisać od razu
+FLUSH_INTERVAL = 1.0
+BATCH_SIZE = 500
+# Co ile zapisów przycinać WAL
+COMPACT_EVERY = 100
+# Ile sekund czekać na magazyn wyników w innym procesie
+STORE_TIMEOUT = 2.0
+
+
+# Nazwy graczy bez rozróżniania wielkości liter - tak porównywał je configparser w config.ini
+def key(name):
+    return name.lower()
+
+
+# Wspólny interfejs magazynów punktów: wyniki łączne po nazwie gracza
+class ScoreStore:
+    def get(self, name):
+        raise NotImplementedError
+
+    # Dodaje punkty i zwraca nową sumę
+    def add(self, name, points):
+        raise NotImplementedError
+
+    # Wszystkie pary (nazwa, suma)
+    def totals(self):
+        raise NotImplementedError
+
+    # Ranking dla serwera; domyślnie budowany w pamięci z sum
+    def leaderboard(self):
+        return Leaderboard(self.totals(), key)
+
+    def close(self):
+        pass
+
+
+# Stary format: cały config.ini, przepisywany w tle co FLUSH_INTERVAL, jeśli coś się
+# zmieniło - jak paczki w SQLite, ale każdy zapis to cały plik, więc to backend dla
+# małych instalacji; przy wielu graczach lepszy jest sqlite
+class IniScoreStore(ScoreStore):
+    def __init__(self, path="config.ini"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.config = configparser.ConfigParser()
+        self.config.read(path, "UTF8")
+        # Czy są punkty, których nie ma jeszcze w pliku
+        self.dirty = False
+        self.closed = False
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def get(self, name):
+        with self.lock:
+            return int(self.config["DEFAULT"].get(name, "0"))
+
+    def add(self, name, points):
+        with self.lock:
+            total = int(self.config["DEFAULT"].get(name, "0")) + points
+            self.config["DEFAULT"][name] = str(total)
+            self.dirty = True
+        return total
+
+    def totals(self):
+        with self.lock:
+            return [(name, int(value)) for name, value in self.config["DEFAULT"].items()]
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.write()
+            self.dirty = False
+
+    # Zapis przez plik tymczasowy, żeby crash w trakcie nie psuł wyników
+    def write(self):
+        temp = self.path + ".tmp"
+        with open(temp, 'w') as config_file:
+            self.config.write(config_file)
+        os.replace(temp, self.path)
+
+    def run(self):
+        while not self.closed:
+            with self.lock:
+                self.flushed.wait(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError as error:
+                print("Unable to save scores: {!r}".format(error))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.flushed.notify()
+        self.writer.join()
+        with self.lock:
+            self.write()
+
+
+# SQLite w trybie WAL: punkty zbierane w pamięci i zapisywane paczkami
+# w jednej transakcji przez osobny wątek (group commit)
+class SqliteScoreStore(ScoreStore):
+    def __init__(self, path="scores.db"):
+        self.path = path
+        fresh = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS scores (name TEXT PRIMARY KEY, total INTEGER NOT NULL)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        # Sumy już znane serwerowi i przyrosty czekające na zapis
+        self.cache = {}
+        self.pending = {}
+        self.flushes = 0
+        self.closed = False
+        # Pierwsze uruchomienie - przenosimy wyniki ze starego config.ini
+        if fresh and os.path.exists("config.ini"):
+            self.import_config("config.ini")
+        elif not fresh:
+            self.normalise()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def import_config(self, path):
+        config = configparser.ConfigParser()
+        config.read(path, "UTF8")
+        rows = []
+        for name, value in config["DEFAULT"].items():
+            try:
+                rows.append((key(name), int(value)))
+            except ValueError:
+                continue
+        with self.lock:
+            # Gracze już obecni w bazie mają nowsze wyniki niż config
+            self.db.executemany("INSERT OR IGNORE INTO scores (name, total) VALUES (?, ?)", rows)
+            self.db.commit()
+            self.cache.clear()
+        return len(rows)
+
+    # Baza ze starszej wersji mogła zapisać nazwy z wielkimi literami - łączymy je z małymi
+    def normalise(self):
+        rows = [(name, total) for name, total in self.db.execute("SELECT name, total FROM scores")
+                if name != key(name)]
+        if not rows:
+            return
+        self.db.executemany("DELETE FROM scores WHERE name = ?", [(name,) for name, _ in rows])
+        self.db.executemany(
+            "INSERT INTO scores (name, total) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET total = total + excluded.total",
+            [(key(name), total) for name, total in rows])
+        self.db.commit()
+
+    def get(self, name):
+        with self.lock:
+            return self.load(key(name))
+
+    def load(self, name):
+        if name not in self.cache:
+            row = self.db.execute("SELECT total FROM scores WHERE name = ?", (name,)).fetchone()
+            self.cache[name] = row[0] if row else 0
+        return self.cache[name]
+
+    def add(self, name, points):
+        name = key(name)
+        with self.lock:
+            total = self.load(name) + points
+            self.cache[name] = total
+            self.pending[name] = self.pending.get(name, 0) + points
+            if len(self.pending) >= BATCH_SIZE:
+                self.flushed.notify()
+        return total
+
+    def totals(self):
+        self.flush()
+        with self.lock:
+            return self.db.execute("SELECT name, total FROM scores").fetchall()
+
+    # Zapis przyrostów, a nie sum - kilka procesów może dzielić jedną bazę
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            try:
+                self.db.executemany(
+                    "INSERT INTO scores (name, total) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET total = total + excluded.total",
+                    pending.items())
+                self.db.commit()
+            except sqlite3.Error:
+                # Nieudany zapis wraca do kolejki na następną próbę
+                self.db.rollback()
+                for name, points in pending.items():
+                    self.pending[name] = self.pending.get(name, 0) + points
+                raise
+            self.flushes += 1
+            if self.flushes % COMPACT_EVERY == 0:
+                self.compact()
+
+    # Przeniesienie WAL do bazy i przycięcie go do zera
+    def compact(self):
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def run(self):
+        while not self.closed:
+            with self.lock:
+                self.flushed.wait(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except sqlite3.Error as error:
+                print("Unable to save scores: {!r}".format(error))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.flushed.notify()
+        self.writer.join()
+        self.flush()
+        with self.lock:
+            self.compact()
+            self.db.close()
+
+
+# Magazyn w osobnym procesie (store.py), wspólny dla kilku serwerów. Punkty idą do niego
+# paczkami jak w SQLite, a sumy i ranking liczy tylko on - więc add nie zna nowej sumy
+# i zwraca None, a ranking serwera tylko pyta magazyn
+class RemoteScoreStore(ScoreStore):
+    def __init__(self, address):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port))
+        # Jedno zapytanie naraz na połączeniu - odpowiedzi przychodzą po kolei.
+        # Wysłanie paczki trzyma go od zabrania punktów z kolejki do odpowiedzi, więc get
+        # widzi każdy punkt dokładnie raz: w magazynie albo w kolejce
+        self.lock = threading.RLock()
+        self.sock = None
+        self.decoder = None
+        self.pending_lock = threading.Lock()
+        self.flushed = threading.Condition(self.pending_lock)
+        self.pending = {}
+        self.closed = False
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    # Zapytanie i odpowiedź; zerwane połączenie jest nawiązywane od nowa, a zapytania
+    # tylko do odczytu (retry) ponawiane raz
+    def call(self, request, retry=True):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.create_connection(self.address, STORE_TIMEOUT)
+                        self.decoder = protocol.Decoder()
+                    self.sock.sendall(protocol.frame(json.dumps(request, ensure_ascii=False)))
+                    messages = []
+                    while not messages:
+                        chunk = self.sock.recv(protocol.READ_SIZE)
+                        if not chunk:
+                            raise ConnectionError("score store closed the connection")
+                        messages = self.decoder.feed(chunk)
+                    break
+                except OSError:
+                    if self.sock is not None:
+                        self.sock.close()
+                        self.sock = None
+                    if attempt or not retry:
+                        raise
+        reply = json.loads(messages[0])
+        if "error" in reply:
+            raise ValueError(reply["error"])
+        return reply["result"]
+
+    # Odczyt, który przy niedostępnym magazynie daje wartość zastępczą - runda
+    # i lobby działają dalej z gorszymi danymi zamiast się wywracać
+    def query(self, request, default):
+        try:
+            return self.call(request)
+        except (OSError, ValueError) as error:
+            print("Score store query failed: {!r}".format(error))
+            return default
+
+    def get(self, name):
+        with self.lock:
+            total = self.query({"op": "get", "name": name}, 0)
+            with self.pending_lock:
+                return total + self.pending.get(name, 0)
+
+    def add(self, name, points):
+        with self.pending_lock:
+            self.pending[name] = self.pending.get(name, 0) + points
+            if len(self.pending) >= BATCH_SIZE:
+                self.flushed.notify()
+        return None
+
+    def totals(self):
+        self.flush()
+        return [tuple(entry) for entry in self.call({"op": "totals"})]
+
+    def leaderboard(self):
+        return RemoteLeaderboard(self)
+
+    def flush(self):
+        with self.lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            try:
+                self.call({"op": "add", "points": [[name, points] for name, points in pending.items()]},
+                          retry=False)
+            except (OSError, ValueError):
+                # Nieudana paczka wraca do kolejki na następną próbę
+                with self.pending_lock:
+                    for name, points in pending.items():
+                        self.pending[name] = self.pending.get(name, 0) + points
+                raise
+
+    def run(self):
+        while not self.closed:
+            with self.pending_lock:
+                self.flushed.wait(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except (OSError, ValueError) as error:
+                print("Unable to send scores: {!r}".format(error))
+
+    def close(self):
+        with self.pending_lock:
+            self.closed = True
+            self.flushed.notify()
+        self.writer.join()
+        try:
+            self.flush()
+        except (OSError, ValueError) as error:
+            print("Unable to send scores: {!r}".format(error))
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+
+# Ranking trzymany przez magazyn; update jest pusty, bo magazyn aktualizuje go sam przy add
+class RemoteLeaderboard:
+    def __init__(self, store):
+        self.store = store
+
+    def update(self, name, score):
+        pass
+
+    def top(self, count, offset=0):
+        return self.store.query({"op": "top", "count": count, "offset": offset}, [])
+
+    def rank(self, name):
+        position = self.store.query({"op": "rank", "name": name}, None)
+        return tuple(position) if position is not None else None
+
+    def __len__(self):
+        return self.store.query({"op": "size"}, 0)
+
+
+# Backend wybierany z linii poleceń: "sqlite:scores.db", "ini:config.ini"
+# albo "remote:HOST:PORT" (store.py)
+def open_store(spec):
+    kind, _, path = spec.partition(":")
+    if kind == "sqlite":
+        return SqliteScoreStore(path or "scores.db")
+    if kind == "ini":
+        return IniScoreStore(path or "config.ini")
+    if kind == "remote":
+        return RemoteScoreStore(path or "127.0.0.1:7390")
+    raise ValueError("Unknown score store: {}".format(spec))
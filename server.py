@@ -1,110 +1,170 @@
 #!/usr/bin/env python3
 
-import configparser
+import asyncio
+import queue
+import itertools
 import threading
 import socket
 import argparse
 import os
 import json
-import random
 import time
+import secrets
 
-# Liczba graczy potrzebna do rozpoczęcia
-MIN_PLAYERS = 3
-
-# Pula haseł
-TITLES = [
-    "Python",
-    "3",
-    "JavaScript",
-    "Hamburger",
-    "Wieloryb",
-    "Szkoła",
-    "Uniwersytet",
-    "Remiza",
-    "Pomidor",
-    "Radość",
-    "Młot",
-    "Baran",
-    "Hiacynt",
-    "Jedzenie w samolocie",
-    "Rozpacz",
-    "Ciasto",
-    "Słońce",
-    "Pantofel",
-    "Widmo",
-    "Dama",
-    "Krawędź",
-    "Japonki",
-    "Zamek",
-    "Szmalcownik",
-    "Bazy danych",
-    "Szarada",
-    "Głaz",
-    "Piwnica",
-    "Pióro",
-    "Rachunek prawdopodobieństwa",
-    "Jabłko",
-    "Granat",
-    "Przystań",
-    "Sumo",
-    "Baba",
-    "Tygrys",
-    "Staw",
-    "Oliwa",
-    "Grzebień",
-    "Kuba",
-    "Piła",
-    "Polka",
-    "Warta",
-    "Róża",
-    "Kosa",
-    "Narcyz",
-    "Zebra",
-    "Kapelusz",
-    "Kule",
-    "Mars",
-    "Kiwi",
-    "Mysz"
-]
+import protocol
+import metrics
+import outbound
+from scheduler import Scheduler
+import scores
+import prompts
+import archive
+import dedup
+import snapshot
+import ratelimit
+from room import Room, encode
+
+# Pokój, do którego trafiają klienci bez podanej nazwy
+DEFAULT_ROOM = "main"
+
+PORT = 7312
+
+# Nazwy gracza i pokoju są powtarzane w każdym snapshocie i liście pokojów.
+# Nazwa gracza jest przycinana (klient i tak pozwala na 20 znaków), za długi pokój odrzucany
+MAX_NAME = 20
+MAX_ROOM = 40
+
+# Domyślne czasy faz rundy w sekundach
+DISPLAY_TIME = 10
+SUBMIT_TIMEOUT = 120
+VOTE_TIMEOUT = 60
+
+# Domyślny magazyn wyników
+SCORES = "sqlite:scores.db"
+
+# Wątki robocze do wolniejszej pracy: dysk, wspólny magazyn wyników
+WORKERS = 4
+
+# Od ilu graczy pokój głosuje w trybie dużego pokoju (kartki stronami, wyniki na żywo)
+LARGE_ROOM = 50
+
+# Katalog archiwum rund
+ARCHIVE = "archive"
+
+# Ile sekund gracz po zerwaniu połączenia może wrócić do swojej sesji
+SESSION_GRACE = 30
+
+# Po ilu sekundach znika utworzony pokój, do którego nikt nie dołączył
+EMPTY_ROOM_TIMEOUT = 30
+
+# Co ile sekund ping do klientów i przegląd martwych połączeń
+HEARTBEAT = 10
+# Po ilu sekundach bez żadnych danych od klienta połączenie jest zamykane
+IDLE_TIMEOUT = 30
+# Ile sekund może czekać niedokończona wiadomość
+READ_TIMEOUT = 10
+
+# Po ilu odrzuconych z rzędu wiadomościach klient jest rozłączany
+FLOOD_LIMIT = 200
+
+# Plik ze stanem gier do ciepłego restartu i co ile sekund go zapisywać
+SNAPSHOT = "state.snap"
+SNAPSHOT_INTERVAL = 30
+
+
+# Sesja gracza: token z powitania pozwala wrócić po zerwaniu połączenia
+# z tym samym id, tekstem, głosem i wynikiem
+class Session:
+    def __init__(self, player, username, connection=None, token=None):
+        self.token = token or secrets.token_urlsafe(16)
+        self.player = player
+        self.username = username
+        self.connection = connection
+        self.room = None
+        # Numer odłączenia - timery z wcześniejszych odłączeń są ignorowane
+        self.generation = 0
 
 
 class Server(threading.Thread):
-    def __init__(self, host, port):
+    def __init__(self, host, port, score_store=None, display_time=DISPLAY_TIME,
+                 submit_timeout=SUBMIT_TIMEOUT, vote_timeout=VOTE_TIMEOUT,
+                 queue_limit=outbound.QUEUE_LIMIT, slow_policy=outbound.DROP,
+                 session_grace=SESSION_GRACE, prompt_source=None, round_archive=None,
+                 duplicates=dedup.FLAG, duplicate_threshold=dedup.THRESHOLD, large_room=LARGE_ROOM,
+                 heartbeat=HEARTBEAT, idle_timeout=IDLE_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 snapshot_path=None, snapshot_interval=SNAPSHOT_INTERVAL,
+                 max_message=protocol.MAX_MESSAGE, rate=ratelimit.RATE, burst=ratelimit.BURST,
+                 ip_rate=ratelimit.IP_RATE, ip_burst=ratelimit.IP_BURST):
         super().__init__()
-        self.config = configparser.ConfigParser()
-        self.config.read("config.ini", "UTF8")
-        self.connections = []
+        # Łączne wyniki graczy, wspólne dla wszystkich pokojów
+        self.scores = score_store or scores.open_store(SCORES)
+        # Ranking budowany raz przy starcie, potem aktualizowany przyrostowo
+        # (albo trzymany przez wspólny magazyn wyników)
+        self.leaderboard = self.scores.leaderboard()
+        # id -> połączenie, łącznie z tymi, które są jeszcze w lobby
+        self.connections = {}
         self.host = host
         self.port = port
-        # Init ustawień
-        self.data = {}
-        self.data["title"] = "undefined"
-        self.data["state"] = "wait"
-        self.data["users"] = {}
-        self.data["messages"] = {}
-        self.data["scores"] = {}
-        self.data["total_scores"] = {}
-        self.votes = {}
-
-    # Callowane po każdej rundzie
-    def reset(self):
-        time.sleep(10)
-        print("New round")
-        self.votes = {}
-        self.data["scores"] = {}
-        self.data["messages"] = {}
-        self.data["title"] = random.choice(TITLES)
-        self.data["state"] = "wait"
-        # Stan zależny od liczby graczy
-        if self.player_count() >= MIN_PLAYERS:
-            self.data["state"] = "game"
-        else:
-            self.data["state"] = "wait"
-        dump = json.dumps(self.data, ensure_ascii=False)
-        self.broadcast_all(dump)
+        # Id kolejnego połączenia; po restarcie większe od id graczy ze snapshotu
+        self.idx = 0
+        # Lock lobby: chroni słownik pokojów i połączeń
+        self.lock = threading.RLock()
+        # nazwa -> pokój
+        self.rooms = {}
+        # Czas trwania każdej fazy; wait nie ma terminu
+        self.timeouts = {"game": submit_timeout, "vote": vote_timeout, "display": display_time}
+        # Terminy faz wszystkich pokojów w jednym wątku
+        self.scheduler = Scheduler()
+        # Limit kolejki wyjściowej klienta i co robić po jego przekroczeniu
+        self.queue_limit = queue_limit
+        self.slow_policy = slow_policy
+        # Hasła rund: korpus z pliku albo wbudowana lista
+        self.prompts = prompt_source or prompts.Prompts()
+        self.large_room = large_room
+        # Archiwum rozegranych rund z wyszukiwaniem; None = bez archiwum
+        self.archive = round_archive
+        # Wykrywanie powtórzonych aforyzmów; historia wczytywana z archiwum w tle
+        self.duplicates = duplicates
+        self.similar = None
+        if duplicates != dedup.OFF:
+            self.similar = dedup.Index(threshold=duplicate_threshold)
+            if self.archive is not None:
+                threading.Thread(target=self.similar.seed, args=(self.archive.recent(dedup.HISTORY),
+                                                                 self.similar_path()), daemon=True).start()
+        # token -> sesja; 0 wyłącza powroty
+        self.sessions = {}
+        self.session_grace = session_grace
+        # Wykrywanie półotwartych połączeń; heartbeat 0 wyłącza pingi i przegląd
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        # Snapshot stanu gier; None = bez zapisu i bez ciepłego restartu
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        # Zapis okresowy i ten przy wyjściu nie mogą pisać jednocześnie
+        self.snapshot_lock = threading.Lock()
+        # Ochrona przed zalewaniem: limit długości ramki i kubełki wiadomości
+        # na połączenie i na adres; rate 0 wyłącza limit
+        self.max_message = max_message
+        self.rate = rate
+        self.burst = burst
+        self.addresses = ratelimit.AddressLimits(ip_rate, ip_burst)
+        # Metryki liczone dopiero przy odczycie endpointu
+        metrics.connections.set_function(lambda: len(self.connections))
+        metrics.rooms.set_function(lambda: len(self.rooms))
+        metrics.spectators.set_function(lambda: sum(len(room.audience) for room in list(self.rooms.values())))
+        metrics.queue_depth.set_function(
+            lambda: sum(connection.pending() for connection in list(self.connections.values())))
+        # Zadania dla wątków roboczych: (callback, funkcja, argumenty). Własne wątki
+        # zamiast run_in_executor - pula z concurrent.futures odmawia pracy po końcu
+        # głównego wątku, a serwer działa właśnie w wątku pobocznym
+        self.jobs = queue.Queue()
+        for _ in range(WORKERS):
+            threading.Thread(target=self.work, daemon=True).start()
 
     def run(self):
+        self.scheduler.start()
+        self.start_reaper()
+        self.restore()
         # Init serwera
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -113,143 +173,725 @@ class Server(threading.Thread):
         sock.listen(1)
         print('Listening at', sock.getsockname())
 
-        idx = 0
         try:
             while True:
                 # Czekaj na nowe połączenie i twórz nowe ""wątki""
                 sc, sockname = sock.accept()
-                print('{} has joined'.format(idx))
-                server_socket = ServerSocket(sc, sockname, self, idx)
-                idx += 1
-                server_socket.start()
+                print('{} has joined'.format(self.idx))
+                server_socket = ServerSocket(sc, sockname, self, self.idx)
+                self.idx += 1
                 # self.connections trzyma wszystkie aktualne połączenia
-                self.connections.append(server_socket)
+                self.add_connection(server_socket)
+                server_socket.start()
         except KeyboardInterrupt:
             self.quit()
 
+    def start_reaper(self):
+        if self.heartbeat > 0:
+            self.scheduler.call_later(self.heartbeat, self.reap)
+
+    # Ping do wszystkich (klient odpowiada pong) i zamknięcie połączeń, od których
+    # dawno nic nie przyszło albo które utknęły w połowie wiadomości. Zamknięcie
+    # budzi wątek/zadanie czytające, które sprząta zwykłą ścieżką leave
+    def reap(self):
+        now = time.monotonic()
+        ping = encode({"type": "ping"})
+        with self.lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            since = connection.decoder.since
+            if now - connection.last_seen > self.idle_timeout:
+                reason = "idle"
+            elif since is not None and now - since > self.read_timeout:
+                reason = "read"
+            else:
+                connection.send(ping)
+                continue
+            print('{} timed out ({})'.format(connection.id, reason))
+            metrics.reaped.labels(reason).inc()
+            connection.close()
+        self.scheduler.call_later(self.heartbeat, self.reap)
+
+    # Stan wszystkich pokojów i sesji. Zbierany pod lockami, ale to tylko kopie list,
+    # a kodowanie i zapis idą już bez nich
+    def dump_state(self):
+        with self.lock:
+            rooms = []
+            for room in self.rooms.values():
+                with room.lock:
+                    rooms.append(room.dump())
+            sessions = [[session.token, session.player, session.username, session.room.name]
+                        for session in self.sessions.values() if session.room is not None]
+            return {"time": time.time(), "next_id": self.idx, "rooms": rooms, "sessions": sessions}
+
+    def save_state(self, state):
+        with self.snapshot_lock:
+            try:
+                snapshot.save(self.snapshot_path, state)
+            # Błąd kodowania (np. liczba spoza zakresu msgpack) nie może zabić wątku zapisu
+            except (OSError, ValueError, OverflowError, TypeError) as error:
+                print("Unable to save the game state: {!r}".format(error))
+
+    # Zapis we własnym wątku - fsync nie może wstrzymać harmonogramu ani zająć wątku roboczego
+    def checkpoint(self):
+        self.scheduler.call_later(self.snapshot_interval, self.checkpoint)
+        threading.Thread(target=self.save_state, args=(self.dump_state(),), daemon=True).start()
+
+    # Ciepły restart: pokoje wracają w swojej fazie, a gracze mają okno łaski,
+    # żeby wrócić ze swoim tokenem sesji. Bez sesji gracz nie wróci, więc znika z pokoju.
+    # Snapshot, którego nie da się wczytać ani odtworzyć, jest traktowany jak brak snapshotu
+    def restore(self):
+        if self.snapshot_path is None:
+            return
+        start = time.perf_counter()
+        try:
+            state = snapshot.load(self.snapshot_path)
+        # RecursionError: głęboko zagnieżdżony json
+        except (OSError, ValueError, RecursionError) as error:
+            print("Unable to load the game state: {!r}".format(error))
+            state = None
+        if state is not None:
+            try:
+                self.load_state(state)
+            # Stary format albo filtr, którego nie ma już w korpusie - serwer i tak musi wystartować
+            except Exception as error:
+                print("Unable to restore the game state: {!r}".format(error))
+                self.clear_state()
+            else:
+                print('Restored {} rooms and {} sessions in {:.3f} s'.format(
+                    len(self.rooms), len(self.sessions), time.perf_counter() - start))
+        # Przedział 0 wyłącza zapis okresowy - zostaje tylko ten przy wyjściu
+        if self.snapshot_interval > 0:
+            self.scheduler.call_later(self.snapshot_interval, self.checkpoint)
+
+    def load_state(self, state):
+        # Filtr, którego nowy korpus nie zna, zamienia się na pokój bez filtra
+        filters = {}
+        for saved in state["rooms"]:
+            prompt_filter = (saved["category"], saved["language"])
+            filters[saved["name"]] = prompt_filter if self.prompts.valid(*prompt_filter) else (None, None)
+        # Indeksy filtrów pokojów przed self.lock - Room bierze już gotowe linie
+        for prompt_filter in set(filters.values()):
+            self.prompts.select(*prompt_filter)
+        with self.lock:
+            self.idx = max(self.idx, state["next_id"])
+            for saved in state["rooms"]:
+                room = self.new_room(saved["name"], *filters[saved["name"]])
+                with room.lock:
+                    room.load(saved)
+            if self.session_grace > 0:
+                for token, player, username, name in state["sessions"]:
+                    room = self.rooms.get(name)
+                    if room is None:
+                        continue
+                    session = Session(player, username, token=token)
+                    session.room = room
+                    self.sessions[token] = session
+            players = {session.player for session in self.sessions.values()}
+            for room in list(self.rooms.values()):
+                with room.lock:
+                    for player in list(room.data["users"]):
+                        if player not in players:
+                            room.forget(player)
+                self.drop_room(room)
+            # Jeden timer na wszystkie odtworzone sesje zamiast jednego na gracza
+            if self.sessions:
+                self.scheduler.call_later(self.session_grace, self.expire_restored, list(self.sessions.values()))
+
+    # Porzucenie częściowo odtworzonego stanu; przed startem nikt jeszcze nie jest połączony
+    def clear_state(self):
+        with self.lock:
+            for room in self.rooms.values():
+                with room.lock:
+                    # Nowa faza unieważnia też zaplanowane rozsyłanie czołówki
+                    room.set_state("wait")
+            self.rooms.clear()
+            self.sessions.clear()
+
+    def expire_restored(self, sessions):
+        for session in sessions:
+            self.expire_session(session, 0)
+
     def quit(self):
-        with open("config.ini", 'w') as config_file:
-            self.config.write(config_file)
-        os._exit(0)
+        try:
+            if self.snapshot_path is not None:
+                self.save_state(self.dump_state())
+        except Exception as error:
+            print("Unable to save the game state: {!r}".format(error))
+        finally:
+            self.shutdown()
+
+    # Zamknięcie magazynów i wyjście - proces kończy się nawet przy błędzie zamykania,
+    # inaczej zostałby bez pętli zdarzeń, a gateway czekałby na niego w nieskończoność
+    def shutdown(self):
+        try:
+            self.close_stores()
+        except Exception as error:
+            print("Unable to close the stores: {!r}".format(error))
+        finally:
+            os._exit(0)
+
+    def close_stores(self):
+        self.scores.close()
+        if self.archive is not None:
+            if self.similar is not None:
+                try:
+                    self.similar.save(self.similar_path())
+                except OSError as error:
+                    print("Unable to save the similarity index: {!r}".format(error))
+            self.archive.close()
+
+    # Podpisy indeksu podobieństwa leżą w archiwum, z którego indeks jest wczytywany
+    def similar_path(self):
+        return os.path.join(self.archive.path, "similar.idx")
+
+    # Limit wiadomości sprawdzany przed jakimkolwiek parsowaniem
+    def admit(self, connection):
+        now = time.monotonic()
+        if not connection.limit.take(now):
+            reason = "rate"
+        elif not connection.address_limit.take(now):
+            reason = "address"
+        else:
+            connection.flooding = 0
+            return True
+        metrics.rejected.labels(reason).inc()
+        connection.flooding += 1
+        if connection.flooding == FLOOD_LIMIT:
+            print('{} is flooding, disconnecting'.format(connection.id))
+            connection.close()
+        return False
+
+    # Za długa ramka: klient nie trzyma się protokołu, więc nie ma po co go dalej czytać
+    def oversized(self, connection, error):
+        print('{} sent a bad frame: {}'.format(connection.id, error))
+        metrics.rejected.labels("size").inc()
+
+    # Obsługa jednej wiadomości od klienta, wspólna dla obu trybów serwera
+    def handle(self, connection, message):
+        if not self.admit(connection):
+            return
+        start = time.perf_counter()
+        try:
+            request = json.loads(message)
+            kind = request["type"]
+        # RecursionError: głęboko zagnieżdżone listy mieszczą się w limicie ramki
+        except (ValueError, TypeError, KeyError, RecursionError):
+            return
+        # Etykieta metryki: faza pokoju w chwili przyjścia wiadomości
+        if kind == "join":
+            phase = "join"
+        elif connection.room is not None:
+            phase = connection.room.data["state"]
+        else:
+            phase = "lobby"
+        # Wiadomość, na której obsługa się wywróciła, jest odrzucana - połączenie obsługujemy dalej
+        try:
+            self.dispatch(connection, kind, request)
+        except Exception as error:
+            print('{} sent a message that failed: {!r}'.format(connection.id, error))
+            metrics.rejected.labels("invalid").inc()
+            return
+        metrics.messages.labels(phase).observe(time.perf_counter() - start)
+
+    def dispatch(self, connection, kind, request):
+        # Odpowiedź na ping - wystarczy, że przyszła
+        if kind == "pong":
+            return
+        # Polecenia lobby
+        elif kind == "list":
+            offset, limit = protocol.page(request.get("offset", 0), request.get("limit", 100))
+            self.send(connection, self.list_rooms(offset, limit))
+        # Ranking globalny; ze wspólnym magazynem to zapytanie przez sieć, więc w tle
+        elif kind == "top":
+            offset, count = protocol.page(request.get("offset", 0), request.get("count", 10))
+
+            def reply_top(result):
+                total, entries = result
+                self.send(connection, {"type": "top", "offset": offset, "total": total, "entries": entries})
+            self.background(reply_top, lambda: (len(self.leaderboard), self.leaderboard.top(count, offset)))
+        elif kind == "rank":
+            name = str(request.get("name", connection.username))
+
+            def reply_rank(position):
+                rank, score = position if position is not None else (None, 0)
+                self.send(connection, {"type": "rank", "name": name, "rank": rank, "score": score})
+            self.background(reply_rank, self.leaderboard.rank, name)
+        # Wyszukiwanie w archiwum: słowa i/lub autor, najlepsze albo najnowsze, stronami
+        elif kind == "search":
+            if self.archive is None:
+                self.send(connection, {"type": "error", "reason": "no archive"})
+                return
+            offset, limit = protocol.page(request.get("offset", 0), request.get("limit", 20))
+            query = str(request.get("query") or "")
+            author = str(request.get("author") or "")
+            order = "recent" if request.get("order") == "recent" else "votes"
+
+            def reply(result):
+                entries, more = result
+                self.send(connection, {"type": "results", "query": query, "author": author, "order": order,
+                                       "offset": offset, "entries": entries, "more": more})
+            self.background(reply, self.archive.search, query, author, offset, limit, order)
+        elif kind == "create":
+            name = str(request.get("room", ""))
+            if len(name) > MAX_ROOM:
+                self.reject_room(connection)
+                return
+            prompt_filter = self.prompt_filter(request)
+            if prompt_filter is None:
+                self.send(connection, {"type": "error", "reason": "bad prompt filter"})
+                return
+            if not self.prompts.ready(*prompt_filter):
+                self.build_prompts(connection, kind, request, prompt_filter)
+                return
+            with self.lock:
+                if not name or name in self.rooms:
+                    self.send(connection, {"type": "error", "reason": "room exists"})
+                    return
+                room = self.new_room(name, *prompt_filter)
+            # Bez tego pusty pokój zostałby na zawsze - drop_room woła dopiero wyjście gracza lub widza
+            self.scheduler.call_later(EMPTY_ROOM_TIMEOUT, self.drop_room, room)
+            self.send(connection, {"type": "room", "room": room.info()})
+        # Nie ma zainicjalizowanego username => ten klient się wita
+        elif kind == "join" and connection.room is None:
+            # Widz może dołączyć do gry - przestaje wtedy tylko oglądać
+            if connection.watching is not None:
+                self.unwatch(connection)
+            self.join(connection, request)
+        elif kind == "leave" and connection.room is not None:
+            with self.lock:
+                self.leave_room(connection)
+                connection.session.room = None
+        # Widz: tylko stan pokoju, bez wpływu na grę
+        elif kind == "watch" and connection.room is None and connection.watching is None:
+            self.watch(connection, request)
+        elif connection.watching is not None:
+            room = connection.watching
+            if kind == "leave":
+                self.unwatch(connection)
+            elif kind == "resync":
+                with room.lock:
+                    room.audience.resync(connection)
+        # Reszta to polecenia gry w pokoju gracza
+        elif connection.room is not None:
+            room = connection.room
+            with room.lock:
+                room.handle(connection, kind, request)
+
+    def join(self, connection, request):
+        # Uzgodnienie kodowania: potwierdzenie idzie jeszcze w json, reszta już w nowym
+        encoding = protocol.negotiate(request.get("encodings"))
+        # Niepoprawny filtr - gracz trafia do pokoju bez filtra
+        prompt_filter = self.prompt_filter(request) or (None, None)
+        name = str(request.get("room", DEFAULT_ROOM))
+        if len(name) > MAX_ROOM:
+            self.reject_room(connection)
+            return
+        with self.lock:
+            session = self.sessions.get(str(request.get("session", "")))
+            if session is not None and session.room is not None:
+                self.resume(connection, session, encoding)
+                return
+            # Nowy pokój z filtrem bez indeksu: indeks powstaje w tle, a join wraca potem,
+            # żeby nie trzymać self.lock przez przeglądanie korpusu
+            room = self.rooms.get(name)
+            if room is None and not self.prompts.ready(*prompt_filter):
+                self.build_prompts(connection, "join", request, prompt_filter)
+                return
+            connection.username = str(request.get("name", ""))[:MAX_NAME]
+            session = connection.session
+            if session is None:
+                session = connection.session = Session(connection.id, connection.username, connection)
+                self.sessions[session.token] = session
+            session.username = connection.username
+            self.send(connection, {"type": "welcome", "encoding": encoding, "session": session.token,
+                                   "heartbeat": self.heartbeat})
+            connection.encoding = encoding
+            room = room or self.new_room(name, *prompt_filter)
+            session.room = room
+            with room.lock:
+                room.join(connection)
+
+    def reject_room(self, connection):
+        metrics.rejected.labels("name").inc()
+        self.send(connection, {"type": "error", "reason": "room name too long"})
+
+    def watch(self, connection, request):
+        encoding = protocol.negotiate(request.get("encodings"))
+        with self.lock:
+            room = self.rooms.get(str(request.get("room", DEFAULT_ROOM)))
+            if room is None:
+                self.send(connection, {"type": "error", "reason": "no such room"})
+                return
+            self.send(connection, {"type": "welcome", "encoding": encoding, "heartbeat": self.heartbeat})
+            connection.encoding = encoding
+            with room.lock:
+                room.audience.add(connection)
+
+    def unwatch(self, connection):
+        room = connection.watching
+        with self.lock:
+            with room.lock:
+                room.audience.remove(connection)
+            self.drop_room(room)
+
+    # Filtr haseł z żądania jako (kategoria, język); None, gdy korpus nie ma takich wartości
+    def prompt_filter(self, request):
+        category, language = (str(request[key]) if request.get(key) else None for key in ("category", "language"))
+        if not self.prompts.valid(category, language):
+            return None
+        return category, language
+
+    # Pierwsze użycie filtra przegląda cały korpus, więc idzie w tle, a polecenie
+    # jest obsługiwane ponownie, gdy indeks filtra już jest
+    def build_prompts(self, connection, kind, request, prompt_filter):
+        def retry(lines):
+            if not connection.closed:
+                self.dispatch(connection, kind, request)
+        self.background(retry, self.prompts.select, *prompt_filter)
+
+    def new_room(self, name, category=None, language=None):
+        room = self.rooms[name] = Room(name, self, category, language)
+        return room
 
-    def broadcast(self, message, source):
-        for connection in self.connections:
-            # Wyślij wiadomość do wszystkich oprócz source
-            if connection.sockname != source:
-                connection.send(message)
+    # Powrót do sesji: nowe połączenie przejmuje id gracza i dostaje jeden snapshot
+    def resume(self, connection, session, encoding):
+        previous = session.connection
+        if connection.session is not None and connection.session is not session:
+            self.sessions.pop(connection.session.token, None)
+        self.connections.pop(connection.id, None)
+        connection.id = session.player
+        self.connections[connection.id] = connection
+        connection.username = session.username
+        connection.session = session
+        session.connection = connection
+        session.generation += 1
+        self.send(connection, {"type": "welcome", "encoding": encoding, "session": session.token,
+                               "heartbeat": self.heartbeat, "resumed": True})
+        connection.encoding = encoding
+        room = session.room
+        with room.lock:
+            room.resume(connection, previous)
+        # Stare połączenie mogło jeszcze nie zauważyć zerwania - zamykamy je bez sprzątania gracza
+        if previous is not None:
+            previous.session = None
+            previous.close()
+        print('{} has resumed'.format(connection.id))
 
-    def broadcast_all(self, message):
-        for connection in self.connections:
-            connection.send(message)
+    # Zerwane połączenie: gracz czeka w pokoju do końca okna łaski
+    def detach(self, connection):
+        session = connection.session
+        room = connection.room
+        with room.lock:
+            room.detach(connection)
+        session.connection = None
+        session.generation += 1
+        self.scheduler.call_later(self.session_grace, self.expire_session, session, session.generation)
 
+    def expire_session(self, session, generation):
+        with self.lock:
+            if session.connection is not None or session.generation != generation:
+                return
+            self.sessions.pop(session.token, None)
+            room = session.room
+            session.room = None
+            if room is None:
+                return
+            with room.lock:
+                room.forget(session.player)
+                room.settle()
+            self.drop_room(room)
+
+    def send(self, connection, message):
+        connection.send(encode(message))
+
+    # Wolniejsza praca (dysk, magazyn przez sieć) idzie do wątków roboczych, żeby nie
+    # trzymać locków ani wątku harmonogramu. Callback sam bierze potrzebne locki
+    def background(self, callback, function, *args):
+        self.jobs.put((callback, function, args))
+
+    def work(self):
+        while True:
+            callback, function, args = self.jobs.get()
+            try:
+                result = function(*args)
+            except Exception as error:
+                print("Background job failed: {!r}".format(error))
+                continue
+            self.deliver(callback, result)
+
+    # W trybie wątków odpowiedź obsługuje od razu wątek roboczy
+    def deliver(self, callback, result):
+        try:
+            callback(result)
+        except Exception as error:
+            print("Background callback failed: {!r}".format(error))
+
+    # Stronicowana lista pokojów, żeby przy tysiącach nie wysyłać wszystkich
+    def list_rooms(self, offset, limit):
+        with self.lock:
+            rooms = [room.info() for room in itertools.islice(self.rooms.values(), offset, offset + limit)]
+            total = len(self.rooms)
+        return {"type": "rooms", "rooms": rooms, "offset": offset, "total": total}
+
+    def leave_room(self, connection):
+        room = connection.room
+        with room.lock:
+            room.leave(connection)
+        self.drop_room(room)
+
+    # Pusty pokój znika z lobby; odłączeni gracze z sesją i widzowie też go trzymają
+    def drop_room(self, room):
+        with self.lock:
+            if not room.data["users"] and not room.audience and self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+
+    # Rozłączenie klienta: z sesją gracz może jeszcze wrócić, bez niej znika z danych
+    def leave(self, connection):
+        print('{} has left'.format(connection.id))
+        self.addresses.release(connection.address)
+        with self.lock:
+            if connection.watching is not None:
+                self.unwatch(connection)
+            session = connection.session
+            if connection.room is not None and session is not None and self.session_grace > 0:
+                self.detach(connection)
+            else:
+                if connection.room is not None:
+                    self.leave_room(connection)
+                if session is not None:
+                    self.sessions.pop(session.token, None)
+        connection.close()
+        self.remove_connection(connection)
+
+    def add_connection(self, connection):
+        with self.lock:
+            self.connections[connection.id] = connection
+
+    # Po powrocie do sesji to samo id ma już nowe połączenie
     def remove_connection(self, connection):
-        self.connections.remove(connection)
+        with self.lock:
+            if self.connections.get(connection.id) is connection:
+                del self.connections[connection.id]
 
-    def player_count(self):
-        return len(self.connections)
 
+# Serwer na jednej pętli asyncio - bez wątku na każde połączenie
+class AsyncServer(Server):
+    def __init__(self, host, port, score_store=None, **options):
+        super().__init__(host, port, score_store, **options)
+        self.loop = None
 
-# Klasa reprezentująca jedno połączenie
-class ServerSocket(threading.Thread):
-    def __init__(self, sc, sockname, server, id):
-        super().__init__()
-        self.sc = sc
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.quit()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        # Pętla asyncio sama trzyma kopiec timerów i ma to samo call_later
+        self.scheduler = self.loop
+        self.start_reaper()
+        self.restore()
+        sock_server = await asyncio.start_server(
+            self.accept, self.host, self.port, reuse_address=True, backlog=1024)
+        print('Listening at', sock_server.sockets[0].getsockname())
+        async with sock_server:
+            await sock_server.serve_forever()
+
+    # Stan pokojów zmienia tylko pętla, więc odpowiedź z wątku roboczego wraca do niej
+    def deliver(self, callback, result):
+        self.loop.call_soon_threadsafe(callback, result)
+
+    async def accept(self, reader, writer):
+        print('{} has joined'.format(self.idx))
+        connection = AsyncConnection(reader, writer, self, self.idx)
+        self.idx += 1
+        self.add_connection(connection)
+        await connection.run()
+
+
+# Stan połączenia wspólny dla obu trybów serwera; wysyłanie i zamykanie są już
+# osobne dla wątków i asyncio
+class Connection:
+    def __init__(self, server, id, sockname):
         self.id = id
         self.sockname = sockname
+        self.address = sockname[0] if sockname else ""
         self.server = server
         self.username = ""
+        self.room = None
+        # Pokój oglądany bez grania
+        self.watching = None
+        self.session = None
+        self.decoder = protocol.Decoder(server.max_message)
+        # Limity wiadomości: własny i wspólny dla adresu; ile odrzuconych z rzędu
+        self.limit = ratelimit.TokenBucket(server.rate, server.burst)
+        self.address_limit = server.addresses.acquire(self.address)
+        self.flooding = 0
+        # Czas ostatnich danych od klienta, dla przeglądu martwych połączeń
+        self.last_seen = time.monotonic()
+        # Kodowanie wiadomości serwera, ustalane przy join
+        self.encoding = "json"
+        self.queue = outbound.OutboundQueue(server.queue_limit, server.slow_policy, self.snapshot)
+        self.closed = False
+
+    def snapshot(self):
+        room = self.room or self.watching
+        return room.snapshot_payload(self).frame(self.encoding) if room is not None else None
+
+
+# Jedno połączenie w trybie asyncio
+class AsyncConnection(Connection):
+    def __init__(self, reader, writer, server, id):
+        super().__init__(server, id, writer.get_extra_info('peername'))
+        self.reader = reader
+        self.writer = writer
+        self.ready = asyncio.Event()
+
+    async def run(self):
+        flusher = asyncio.ensure_future(self.flush())
+        try:
+            while True:
+                chunk = await self.reader.read(protocol.READ_SIZE)
+                if not chunk:
+                    break
+                self.last_seen = time.monotonic()
+                for message in self.decoder.feed(chunk):
+                    self.server.handle(self, message)
+        except ConnectionError:
+            pass
+        except ValueError as error:
+            self.server.oversized(self, error)
+        # Cokolwiek zakończy zadanie, gracz i jego limity muszą zostać zwolnione
+        finally:
+            self.server.leave(self)
+            flusher.cancel()
+
+    # Wysyłanie w osobnym zadaniu: zbiera wszystko z kolejki i czeka na drain
+    async def flush(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue and not self.closed:
+                    self.writer.write(self.queue.pop_all())
+                    await self.writer.drain()
+        except ConnectionError:
+            self.close()
+
+    def send(self, payload, kind=None):
+        if self.closed:
+            return
+        message = payload.frame(self.encoding)
+        metrics.sent_bytes.labels(self.encoding).inc(len(message))
+        if not self.queue.push(message, kind):
+            print('{} is too slow, disconnecting'.format(self.id))
+            self.close()
+            return
+        self.ready.set()
+
+    # Bajty czekające w kolejce i w buforze transportu
+    def pending(self):
+        return self.queue.size + self.writer.transport.get_write_buffer_size()
+
+    # abort zamiast close: close czeka na wysłanie bufora, a półotwarte połączenie nigdy go nie odbierze
+    def close(self):
+        self.closed = True
+        self.writer.transport.abort()
+
+
+# Klasa reprezentująca jedno połączenie
+class ServerSocket(Connection, threading.Thread):
+    def __init__(self, sc, sockname, server, id):
+        threading.Thread.__init__(self)
+        Connection.__init__(self, server, id, sockname)
+        self.sc = sc
+        self.ready = threading.Condition()
+        # Osobny wątek wysyłający, żeby broadcast nie czekał na sendall
+        self.writer = threading.Thread(target=self.flush, daemon=True)
 
     # Rozłącz i usuń się z danych
     def call_quit(self):
-        print('{} has left'.format(self.id))
-        self.server.data["users"].pop(self.id, None)
-        self.server.data["messages"].pop(self.id, None)
-        self.server.data["scores"].pop(self.id, None)
-        self.server.data["total_scores"].pop(self.id, None)
-        self.server.votes.pop(self.id, None)
-        self.sc.close()
-        server.remove_connection(self)
-        if self.server.player_count() == 0:
-            self.server.data["state"] = "wait"
+        self.server.leave(self)
 
     def run(self):
+        self.writer.start()
         try:
-            data = self.server.data
             while True:
-                message = self.sc.recv(1024).decode('utf8')
-                if not message:
-                    self.call_quit()
+                chunk = self.sc.recv(protocol.READ_SIZE)
+                if not chunk:
                     return
-                elif message:
-                    # Nie ma zainicjalizowanego username => ten klient się wita
-                    if self.username == "":
-                        self.username = message
-                        data["users"][self.id] = self.username
-                        # Zmień stan, gdy jest już wystarczająca liczba graczy
-                        if len(data["users"]) >= MIN_PLAYERS and data["state"] == "wait":
-                            data["title"] = random.choice(TITLES)
-                            data["state"] = "game"
-                        dump = json.dumps(data, ensure_ascii=False)
-                        self.server.broadcast(dump, self.sockname)
-                        data_copy = data.copy()
-                        data_copy["playerid"] = self.id
-                        dump = json.dumps(data_copy, ensure_ascii=False)
-                        self.send(dump)
-                    # Klient wysłał aforyzm
-                    elif data["state"] == "game":
-                        data["messages"][self.id] = message
-                        # Zmień stan, gdy wszyscy wysłali
-                        if len(data["messages"]) == self.server.player_count():
-                            data["state"] = "vote"
-                            dump = json.dumps(data, ensure_ascii=False)
-                            self.server.broadcast_all(dump)
-                    # Klient głosuje
-                    elif data["state"] == "vote":
-                        self.server.votes[self.id] = int(message)
-                        if len(self.server.votes) == self.server.player_count():
-                            # Zliczanie głosów
-                            for key in self.server.votes:
-                                player = self.server.votes[key]
-                                if player not in data["scores"]:
-                                    data["scores"][player] = 0
-                                data["scores"][player] += 1
-                            # Naokoło dodawanie ich do totala oraz do configa
-                            # Config jest osobno, bo jeśli są name clashe, to istnieją dwa total_scores i jeden wpis w configu
-                            for player in data["scores"]:
-                                name = data["users"][player]
-                                if player not in data["total_scores"]:
-                                    if name in self.server.config["DEFAULT"]:
-                                        data["total_scores"][player] = int(
-                                            self.server.config["DEFAULT"][name])
-                                    else:
-                                        data["total_scores"][player] = 0
-                                        self.server.config["DEFAULT"][name] = "0"
-                                data["total_scores"][player] += data["scores"][player]
-                                self.server.config["DEFAULT"][name] = str(int(
-                                    int(self.server.config["DEFAULT"][name]) + int(data["scores"][player])))
-                            # Zmiana stanu na display
-                            data["state"] = "display"
-                            dump = json.dumps(data, ensure_ascii=False)
-                            self.server.broadcast_all(dump)
-                            with open("config.ini", 'w') as config_file:
-                                self.server.config.write(config_file)
-                            self.server.reset()
+                self.last_seen = time.monotonic()
+                for message in self.decoder.feed(chunk):
+                    self.server.handle(self, message)
 
         except KeyboardInterrupt or EOFError:
             print("Caught keyboard interrupt, exiting")
             self.call_quit()
             os._exit(0)
-        except ConnectionResetError:
+        except (ConnectionResetError, OSError):
+            pass
+        except ValueError as error:
+            self.server.oversized(self, error)
+        # Cokolwiek zakończy wątek, gracz i jego limity muszą zostać zwolnione
+        finally:
             self.call_quit()
 
-    def send(self, message):
-        self.sc.sendall(message.encode('utf8'))
+    def flush(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                data = self.queue.pop_all()
+            try:
+                self.sc.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+    def send(self, payload, kind=None):
+        message = payload.frame(self.encoding)
+        metrics.sent_bytes.labels(self.encoding).inc(len(message))
+        with self.ready:
+            if self.closed:
+                return
+            if not self.queue.push(message, kind):
+                print('{} is too slow, disconnecting'.format(self.id))
+                self.close()
+                return
+            self.ready.notify()
+
+    def pending(self):
+        return self.queue.size
+
+    # shutdown budzi wątek czytający, który sam posprząta przez call_quit
+    def close(self):
+        with self.ready:
+            if self.closed:
+                return
+            self.closed = True
+            self.ready.notify()
+        try:
+            self.sc.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sc.close()
 
 
 def quit(server):
-    for connection in server.connections:
-        connection.sc.close()
-    os._exit(0)
+    try:
+        # Stan zapisany, zanim zamykane połączenia zaczną wychodzić z pokojów
+        if server.snapshot_path is not None:
+            server.save_state(server.dump_state())
+        for connection in list(server.connections.values()):
+            connection.close()
+    except Exception as error:
+        print("Unable to close the server cleanly: {!r}".format(error))
+    finally:
+        server.shutdown()
 
 
 # Wyjście na Ctrl+C albo Ctrl+Z
@@ -266,9 +908,95 @@ def exit(server):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Aphorism Server')
     parser.add_argument('host', help='Interface the server listens at')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+                        help='Connection handling: one thread per client or a single asyncio loop')
+    parser.add_argument('--display-time', type=float, default=DISPLAY_TIME,
+                        help='Seconds the results are shown before the next round')
+    parser.add_argument('--submit-timeout', type=float, default=SUBMIT_TIMEOUT,
+                        help='Seconds players have to submit an aphorism')
+    parser.add_argument('--vote-timeout', type=float, default=VOTE_TIMEOUT,
+                        help='Seconds players have to vote')
+    parser.add_argument('--scores', default=SCORES,
+                        help='Score backend: sqlite:PATH (WAL, batched writes), ini:PATH (legacy config.ini, '
+                             'rewritten whole once a second; small setups only) '
+                             'or remote:HOST:PORT (shared store.py for several server processes)')
+    parser.add_argument('--import-scores', metavar='CONFIG',
+                        help='Import totals from a legacy config.ini into the SQLite store')
+    parser.add_argument('--prompts', metavar='FILE',
+                        help='Prompt corpus, one "prompt<TAB>category<TAB>language" per line; '
+                             'indexed once into FILE.idx and memory-mapped')
+    parser.add_argument('--archive', default=ARCHIVE, metavar='DIR',
+                        help='Directory for the searchable round archive (empty to disable)')
+    parser.add_argument('--duplicates', choices=dedup.POLICIES, default=dedup.FLAG,
+                        help='What to do with a submission similar to an earlier one: '
+                             'flag it for voters, reject it, or not check at all')
+    parser.add_argument('--duplicate-threshold', type=float, default=dedup.THRESHOLD,
+                        help='Estimated similarity (0-1) from which a submission counts as a near-duplicate')
+    parser.add_argument('--large-room', type=int, default=LARGE_ROOM,
+                        help='Players from which a room votes on paged ballots with live partial results')
+    parser.add_argument('--send-queue', type=int, default=outbound.QUEUE_LIMIT,
+                        help='Bytes that may wait for one slow client before the policy applies')
+    parser.add_argument('--slow-policy', choices=outbound.POLICIES, default=outbound.DROP,
+                        help='drop: replace queued state with one fresh snapshot, disconnect: close the client')
+    parser.add_argument('--session-grace', type=float, default=SESSION_GRACE,
+                        help='Seconds a disconnected player keeps their seat and may resume (0 disables)')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT,
+                        help='Seconds between pings and dead-connection sweeps (0 disables both)')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='Seconds without any data from a client before it is disconnected')
+    parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+                        help='Seconds a partially received message may wait for the rest')
+    parser.add_argument('--max-message', type=int, default=protocol.MAX_MESSAGE,
+                        help='Largest message in bytes a client may send; longer frames close the connection')
+    parser.add_argument('--rate', type=float, default=ratelimit.RATE,
+                        help='Messages per second one connection may send (0 disables the limit)')
+    parser.add_argument('--burst', type=int, default=ratelimit.BURST,
+                        help='Messages one connection may send at once above its rate')
+    parser.add_argument('--ip-rate', type=float, default=ratelimit.IP_RATE,
+                        help='Messages per second all connections from one address may send (0 disables the limit)')
+    parser.add_argument('--ip-burst', type=int, default=ratelimit.IP_BURST,
+                        help='Messages all connections from one address may send at once above their rate')
+    parser.add_argument('--snapshot', default=SNAPSHOT, metavar='FILE',
+                        help='File with the state of all games, written periodically and on exit '
+                             'and loaded on start (empty to disable)')
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL,
+                        help='Seconds between state snapshots (0 saves only on exit)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics over HTTP on this port')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='Interface for the metrics endpoint')
     args = parser.parse_args()
+    # Import zna tylko magazyn SQLite
+    if args.import_scores and not args.scores.startswith("sqlite"):
+        parser.error('--import-scores needs a sqlite:PATH score store')
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_host, args.metrics_port)
+
+    score_store = scores.open_store(args.scores)
+    if args.import_scores:
+        print('Imported {} scores'.format(score_store.import_config(args.import_scores)))
+
+    start = time.perf_counter()
+    prompt_source = prompts.Prompts(args.prompts)
+    print('Loaded {} prompts in {:.3f} s'.format(len(prompt_source), time.perf_counter() - start))
 
-    server = Server(args.host, 7312)
+    options = {"display_time": args.display_time, "submit_timeout": args.submit_timeout,
+               "vote_timeout": args.vote_timeout, "queue_limit": args.send_queue,
+               "slow_policy": args.slow_policy, "session_grace": args.session_grace,
+               "prompt_source": prompt_source,
+               "round_archive": archive.Archive(args.archive) if args.archive else None,
+               "duplicates": args.duplicates, "duplicate_threshold": args.duplicate_threshold,
+               "large_room": args.large_room, "heartbeat": args.heartbeat,
+               "idle_timeout": args.idle_timeout, "read_timeout": args.read_timeout,
+               "snapshot_path": args.snapshot or None, "snapshot_interval": args.snapshot_interval,
+               "max_message": args.max_message, "rate": args.rate, "burst": args.burst,
+               "ip_rate": args.ip_rate, "ip_burst": args.ip_burst}
+    if args.engine == 'async':
+        server = AsyncServer(args.host, args.port, score_store, **options)
+    else:
+        server = Server(args.host, args.port, score_store, **options)
     server.start()
 
     exit = threading.Thread(target=exit, args=(server,))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import struct
+import json
+import time
+import zlib
+import os
+
+import protocol
+import metrics
+
+# Nagłówek: znacznik, format treści (b"m" msgpack, b"j" json) i CRC32 skompresowanej treści
+HEADER = struct.Struct("<4scxxxI")
+MAGIC = b"APS1"
+
+saved = metrics.REGISTRY.histogram(
+    "aphorism_snapshot_seconds", "Time spent encoding and writing one state snapshot")
+size = metrics.REGISTRY.gauge(
+    "aphorism_snapshot_bytes", "Size of the last state snapshot on disk")
+
+
+# Zapis stanu serwera: plik tymczasowy, fsync i rename, więc po awarii na dysku
+# jest zawsze cały poprzedni albo cały nowy snapshot. Słowniki z kluczami int
+# zapisuje wywołujący jako listy par - json nie ma kluczy innych niż str
+def save(path, state):
+    start = time.perf_counter()
+    if protocol.msgpack is not None:
+        kind, body = b"m", protocol.msgpack.packb(state, use_bin_type=True)
+    else:
+        kind, body = b"j", json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode('utf8')
+    body = zlib.compress(body, 1)
+    temp = path + ".tmp"
+    with open(temp, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, kind, zlib.crc32(body)))
+        snapshot_file.write(body)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp, path)
+    # Sam rename też musi trafić na dysk
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    saved.observe(time.perf_counter() - start)
+    size.set(HEADER.size + len(body))
+
+
+# Stan z pliku albo None, gdy pliku nie ma; uszkodzony plik daje ValueError
+def load(path):
+    try:
+        with open(path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < HEADER.size:
+        raise ValueError("truncated snapshot")
+    magic, kind, checksum = HEADER.unpack_from(data)
+    body = data[HEADER.size:]
+    if magic != MAGIC or zlib.crc32(body) != checksum:
+        raise ValueError("corrupt snapshot")
+    try:
+        body = zlib.decompress(body)
+    except zlib.error as error:
+        raise ValueError("corrupt snapshot: {}".format(error))
+    if kind == b"m":
+        if protocol.msgpack is None:
+            raise ValueError("snapshot needs msgpack")
+        try:
+            return protocol.msgpack.unpackb(body, raw=False)
+        # Wszystkie błędy rozpakowania msgpack jako jeden rodzaj
+        except Exception as error:
+            raise ValueError("corrupt snapshot: {!r}".format(error))
+    return json.loads(body)
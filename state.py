@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Wersjonowany stan gry: serwer wysyła pełny snapshot przy dołączeniu
+# (albo na żądanie resync), a potem tylko różnice między wersjami
+
+
+# Kopia danych z kluczami jako str - tak jak po przejściu przez json
+def plain(data):
+    if isinstance(data, dict):
+        return {str(key): plain(value) for key, value in data.items()}
+    return data
+
+
+# Różnica dwóch stanów jako listy ścieżek:
+# changes = [[ścieżka, wartość], ...], removed = [ścieżka, ...]
+def diff(old, new, path=None, changes=None, removed=None):
+    if path is None:
+        path, changes, removed = [], [], []
+    for key, value in new.items():
+        if key not in old:
+            changes.append([path + [key], value])
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            diff(old[key], value, path + [key], changes, removed)
+        elif old[key] != value:
+            changes.append([path + [key], value])
+    for key in old:
+        if key not in new:
+            removed.append(path + [key])
+    return changes, removed
+
+
+# Nałożenie różnicy na dane klienta
+def apply(data, changes, removed):
+    for path in removed:
+        target = data
+        for key in path[:-1]:
+            target = target.get(key, {})
+        target.pop(path[-1], None)
+    for path, value in changes:
+        target = data
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+    return data
+
+
+class GameState:
+    def __init__(self, data):
+        self.data = data
+        self.version = 0
+        # Ostatnio rozesłany stan, względem niego liczona jest kolejna delta
+        self.published = plain(data)
+
+    # Zatwierdza zmiany w self.data; zwraca deltę albo None, jeśli nic się nie zmieniło
+    def commit(self):
+        current = plain(self.data)
+        changes, removed = diff(self.published, current)
+        if not changes and not removed:
+            return None
+        self.version += 1
+        self.published = current
+        return {"type": "delta", "version": self.version,
+                "changes": changes, "removed": removed}
+
+    def snapshot(self, **extra):
+        message = {"type": "snapshot", "version": self.version, "data": self.published}
+        message.update(extra)
+        return message
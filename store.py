@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import threading
+import asyncio
+import argparse
+import json
+import os
+
+import protocol
+import scores
+
+# Port magazynu wyników wspólnego dla procesów serwera
+STORE_PORT = 7390
+
+
+# Wspólny magazyn wyników i ranking dla kilku procesów serwera (scores.RemoteScoreStore).
+# Lokalny zamiennik np. posortowanego zbioru w Redisie: sumy w SQLite, ranking w pamięci.
+# Zapytania to ramki json {"op": ...}, odpowiedź {"result": ...} albo {"error": ...}
+class StoreServer:
+    def __init__(self, store):
+        self.store = store
+        self.leaderboard = store.leaderboard()
+
+    def execute(self, request):
+        try:
+            op = request["op"]
+            if op == "add":
+                for name, points in request["points"]:
+                    self.leaderboard.update(name, self.store.add(str(name), int(points)))
+                result = None
+            elif op == "get":
+                result = self.store.get(str(request["name"]))
+            elif op == "top":
+                result = self.leaderboard.top(int(request["count"]), int(request["offset"]))
+            elif op == "rank":
+                result = self.leaderboard.rank(str(request["name"]))
+            elif op == "size":
+                result = len(self.leaderboard)
+            elif op == "totals":
+                result = self.store.totals()
+            else:
+                return {"error": "unknown op {!r}".format(op)}
+        except (KeyError, TypeError, ValueError) as error:
+            return {"error": repr(error)}
+        return {"result": result}
+
+    async def accept(self, reader, writer):
+        decoder = protocol.Decoder()
+        try:
+            while True:
+                chunk = await reader.read(protocol.READ_SIZE)
+                if not chunk:
+                    break
+                for message in decoder.feed(chunk):
+                    try:
+                        reply = self.execute(json.loads(message))
+                    except ValueError:
+                        reply = {"error": "bad request"}
+                    writer.write(protocol.frame(json.dumps(reply, ensure_ascii=False)))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, host, port):
+        store_server = await asyncio.start_server(self.accept, host, port, reuse_address=True)
+        print('Score store at', store_server.sockets[0].getsockname())
+        async with store_server:
+            await store_server.serve_forever()
+
+
+# Wyjście po zamknięciu wejścia (tak zatrzymuje magazyn gateway) albo Ctrl+C
+def exit(store):
+    try:
+        while True:
+            input('')
+    except (KeyboardInterrupt, EOFError):
+        pass
+    store.close()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aphorism shared score store')
+    parser.add_argument('host', help='Interface the store listens at')
+    parser.add_argument('--port', type=int, default=STORE_PORT)
+    parser.add_argument('--scores', default='sqlite:scores.db',
+                        help='Backend behind the store: sqlite:PATH or ini:PATH')
+    args = parser.parse_args()
+
+    score_store = scores.open_store(args.scores)
+    threading.Thread(target=exit, args=(score_store,), daemon=True).start()
+    try:
+        asyncio.run(StoreServer(score_store).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        score_store.close()
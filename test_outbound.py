@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import outbound
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshots = 0
+
+    def snapshot(self):
+        self.snapshots += 1
+        return b"S" * 50
+
+    def test_reply_over_limit_replaces_deltas_with_snapshot(self):
+        queue = outbound.OutboundQueue(100, outbound.DROP, self.snapshot)
+        queue.push(b"d" * 40, "delta")
+        queue.push(b"d" * 40, "delta")
+        self.assertTrue(queue.push(b"r" * 30))
+        self.assertEqual(self.snapshots, 1)
+        self.assertEqual(list(queue.frames), [(b"S" * 50, "snapshot"), (b"r" * 30, None)])
+        self.assertEqual(queue.size, 80)
+
+    def test_reply_over_limit_without_state_is_dropped(self):
+        queue = outbound.OutboundQueue(100, outbound.DROP, self.snapshot)
+        queue.push(b"r" * 80)
+        self.assertTrue(queue.push(b"r" * 30))
+        self.assertEqual(self.snapshots, 0)
+        self.assertEqual(len(queue), 1)
+
+    def test_delta_over_limit_becomes_snapshot(self):
+        queue = outbound.OutboundQueue(100, outbound.DROP, self.snapshot)
+        queue.push(b"r" * 20)
+        queue.push(b"d" * 40, "delta")
+        queue.push(b"d" * 50, "delta")
+        self.assertEqual([kind for _, kind in queue.frames], [None, "snapshot"])
+
+    def test_disconnect_policy(self):
+        queue = outbound.OutboundQueue(100, outbound.DISCONNECT, self.snapshot)
+        queue.push(b"d" * 80, "delta")
+        self.assertFalse(queue.push(b"d" * 30, "delta"))
+
+
+if __name__ == '__main__':
+    unittest.main()